@@ -1,12 +1,27 @@
 import logging
+import logging.handlers
 import json
 import os
 import re
+import queue
+import time
+import secrets
 import asyncio
+import bisect
+import difflib
+import heapq
+import itertools
+import threading
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, List, Optional
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, Message
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -16,6 +31,11 @@ from telegram.ext import (
     ContextTypes
 )
 
+try:
+    import orjson
+except ImportError:  # Fall back to the stdlib encoder when orjson isn't installed
+    orjson = None
+
 # Configuration
 TOKEN = "" #add your bot token
 DATA_DIR = "message-store"
@@ -24,16 +44,92 @@ os.makedirs(DATA_DIR, exist_ok=True)
 # File paths
 MESSAGE_STORE_PATH = os.path.join(DATA_DIR, "message_store.json")
 MESSAGE_BATCH_PATH = os.path.join(DATA_DIR, "message_batch.json")
+MESSAGE_STORE_LOG_PATH = os.path.join(DATA_DIR, "message_store.jsonl")
+MESSAGE_BATCH_LOG_PATH = os.path.join(DATA_DIR, "message_batch.jsonl")
 STATS_PATH = os.path.join(DATA_DIR, "stats.json")
+STATS_LOG_PATH = os.path.join(DATA_DIR, "stats.jsonl")
 BATCHES_PATH = os.path.join(DATA_DIR, "batches.json")
-
-# Setup logging
-logging.basicConfig(
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    level=logging.INFO
-)
+BATCHES_LOG_PATH = os.path.join(DATA_DIR, "batches.jsonl")
+SUBSCRIPTIONS_PATH = os.path.join(DATA_DIR, "subscriptions.json")
+USER_PROFILES_PATH = os.path.join(DATA_DIR, "user_profiles.json")
+SHARE_TOKENS_PATH = os.path.join(DATA_DIR, "share_tokens.json")
+SHARE_TOKENS_LOG_PATH = os.path.join(DATA_DIR, "share_tokens.jsonl")
+
+# Setup logging: handlers only enqueue records, a listener thread does the writing
+_log_queue = queue.Queue(-1)
+_log_stream = logging.StreamHandler()
+_log_stream.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
+logging.root.addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.root.setLevel(logging.INFO)
+log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
 logger = logging.getLogger(__name__)
 
+class FsyncPolicy:
+    """Decide when a saved file should be fsync'ed before it is renamed into place"""
+    NEVER = "never"
+    EVERY_N = "every_n"
+    INTERVAL = "interval"
+
+    def __init__(self, mode: str = NEVER, every: int = 1, interval: float = 0.0):
+        self.mode = mode
+        self.every = every
+        self.interval = interval
+        self._writes = 0
+        self._last_sync = 0.0
+
+    def should_sync(self) -> bool:
+        if self.mode == FsyncPolicy.EVERY_N:
+            self._writes += 1
+            if self._writes >= self.every:
+                self._writes = 0
+                return True
+        elif self.mode == FsyncPolicy.INTERVAL:
+            current_time = time.monotonic()
+            if current_time - self._last_sync >= self.interval:
+                self._last_sync = current_time
+                return True
+        return False
+
+# Files not listed here are never fsync'ed; losing a few seconds of stats is fine,
+# losing batch definitions is not.
+FSYNC_POLICIES = {
+    BATCHES_LOG_PATH: FsyncPolicy(FsyncPolicy.INTERVAL, interval=30)
+}
+
+# Minimum number of seconds between two writes of the same JSON file
+SAVE_INTERVAL = 5
+
+# Files with their own interval. Stats change on every view and page turn but are
+# only counters, so they are written less often; shutdown still flushes them.
+SAVE_INTERVALS = {
+    STATS_LOG_PATH: 60
+}
+
+# Seconds a button that asked for a reply (description, banner, date, ...) keeps waiting for it
+PENDING_INPUT_TTL = 600
+
+# How long the flusher waits after the first change so a burst lands in one write
+FLUSH_GROUP_DELAY = 0.1
+
+# A message log is rewritten once it holds this many more lines than live entries
+LOG_COMPACT_SLACK = 1000
+
+# Upper bounds for a single vectored write of pending log lines
+LOG_BATCH_MAX_ENTRIES = 1000
+LOG_BATCH_MAX_BYTES = 64 * 1024
+
+# Concurrent subscriber notifications, kept under Telegram's ~30 messages/second limit
+NOTIFY_CONCURRENCY = 30
+
+# Seconds a viewed message (the reply and the button message) stays before it is deleted
+VIEW_TTL = 300
+
+# Message types the bot stores, in display order
+_MSG_TYPE_KEYS = ("text", "photo", "video", "document", "audio", "voice", "sticker", "animation")
+
+# Single worker so file writes never interleave with each other
+_io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-io")
+
 class FileManager:
     @staticmethod
     def load_data(filepath: str, default=None):
@@ -41,88 +137,744 @@ class FileManager:
             default = {}
         try:
             if os.path.exists(filepath):
-                with open(filepath, "r") as f:
-                    return json.load(f)
+                with open(filepath, "rb") as f:
+                    buf = f.read()
+                return orjson.loads(buf) if orjson is not None else json.loads(buf)
         except Exception as e:
             logger.error(f"Error loading {filepath}: {e}")
         return default
 
+    @staticmethod
+    def write_all(fd: int, buf: bytes):
+        view = memoryview(buf)
+        while view:  # Loop only on a short write
+            view = view[os.write(fd, view):]
+
+    @staticmethod
+    def write_vectored(fd: int, bufs: list):
+        """Write many buffers with one syscall per LOG_BATCH_MAX_* sized chunk"""
+        if not hasattr(os, "writev"):  # Windows
+            FileManager.write_all(fd, b"".join(bufs))
+            return
+        start = 0
+        while start < len(bufs):
+            end = start
+            size = 0
+            while (end < len(bufs) and end - start < LOG_BATCH_MAX_ENTRIES
+                   and (size == 0 or size + len(bufs[end]) <= LOG_BATCH_MAX_BYTES)):
+                size += len(bufs[end])
+                end += 1
+            written = os.writev(fd, bufs[start:end])
+            if written < size:
+                FileManager.write_all(fd, b"".join(bufs[start:end])[written:])
+            start = end
+
+    @staticmethod
+    def write_atomic(filepath: str, buf: bytes):
+        """Write buf to a temp file and rename it over filepath"""
+        tmp_path = filepath + ".tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            FileManager.write_all(fd, buf)
+            policy = FSYNC_POLICIES.get(filepath)
+            if policy and policy.should_sync():
+                os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, filepath)
+
     @staticmethod
     def save_data(filepath: str, data):
+        """Serialize data in one go and atomically replace filepath with it"""
+        try:
+            if orjson is not None:
+                buf = orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+            else:
+                buf = json.dumps(data, separators=(",", ":")).encode()
+            FileManager.write_atomic(filepath, buf)
+            return True
+        except Exception as e:
+            logger.error(f"Error saving {filepath}: {e}")
+            return False
+
+    @staticmethod
+    def encode_line(entry: dict) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(entry) + b"\n"
+        return json.dumps(entry).encode() + b"\n"
+
+    @staticmethod
+    def load_log(filepath: str, legacy_path: str = None):
+        """Rebuild a dict from an append-only JSON-lines log.
+
+        Each line holds {key: value}; a null value deletes the key. If the log
+        doesn't exist yet it is created from the legacy JSON file. Returns the
+        data and the number of lines read.
+        """
+        data = {}
+        lines = 0
+        try:
+            if os.path.exists(filepath):
+                with open(filepath, "rb") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        lines += 1
+                        try:
+                            entry = orjson.loads(line) if orjson is not None else json.loads(line)
+                        except ValueError:
+                            logger.error(f"Skipping corrupt line {lines} in {filepath}")
+                            continue
+                        for key, value in entry.items():
+                            if value is None:
+                                data.pop(key, None)
+                            else:
+                                data[key] = value
+            elif legacy_path and os.path.exists(legacy_path):
+                data = FileManager.load_data(legacy_path)
+                FileManager.save_log(filepath, data)
+                lines = len(data)
+        except Exception as e:
+            logger.error(f"Error loading {filepath}: {e}")
+        return data, lines
+
+    @staticmethod
+    def load_counter_log(filepath: str, legacy_path: str = None):
+        """Rebuild counters from an append-only log of increments.
+
+        Each line holds {counter: {key: delta}} and the deltas are summed, so a
+        compacted log is a single line with the full counts. If the log doesn't
+        exist yet it is created from the legacy JSON file. Returns the counters
+        and the number of lines read.
+        """
+        counters = defaultdict(Counter)
+        lines = 0
+        try:
+            if os.path.exists(filepath):
+                with open(filepath, "rb") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        lines += 1
+                        try:
+                            entry = orjson.loads(line) if orjson is not None else json.loads(line)
+                        except ValueError:
+                            logger.error(f"Skipping corrupt line {lines} in {filepath}")
+                            continue
+                        for name, deltas in entry.items():
+                            counters[name].update(deltas)
+            elif legacy_path and os.path.exists(legacy_path):
+                for name, counts in FileManager.load_data(legacy_path).items():
+                    counters[name].update(counts)
+                FileManager.write_atomic(filepath, FileManager.encode_line(counters))
+                lines = 1
+        except Exception as e:
+            logger.error(f"Error loading {filepath}: {e}")
+        return counters, lines
+
+    @staticmethod
+    def write_counter_log(filepath: str, compact: bool, counts: dict) -> bool:
+        """Append one line of increments, or replace the whole log with the full counts"""
+        if not counts and not compact:
+            return True
         try:
-            with open(filepath, "w") as f:
-                json.dump(data, f, indent=2)
+            line = FileManager.encode_line(counts)
+            if compact:
+                FileManager.write_atomic(filepath, line)
+            else:
+                fd = os.open(filepath, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    FileManager.write_all(fd, line)
+                finally:
+                    os.close(fd)
+            return True
         except Exception as e:
             logger.error(f"Error saving {filepath}: {e}")
+            return False
+
+    @staticmethod
+    def save_log(filepath: str, data: dict):
+        """Rewrite a log with one line per live entry"""
+        FileManager.write_atomic(
+            filepath,
+            b"".join(FileManager.encode_line({key: value}) for key, value in data.items())
+        )
+
+class TTLCache:
+    """Size-bounded LRU mapping whose entries also expire after ttl seconds.
+
+    Lookups, inserts and evictions are all O(1); expired entries are dropped
+    when they are read or pushed out by newer ones.
+    """
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value), oldest first
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            return default
+        if item[0] <= time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return item[1]
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def __getitem__(self, key):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            raise KeyError(key)
+        return value
+
+    def __setitem__(self, key, value):
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+_MISSING = object()
+
+class TrigramIndex:
+    """Substring search over short texts: trigram -> keys whose texts contain it.
+
+    A text containing the query contains all of its trigrams, so intersecting
+    their key sets gives a small superset of the matches, which search()
+    confirms with `in` against the texts lowercased once when they were added.
+    Queries too short to have a trigram are found with str.find over all the
+    texts joined into one string.
+    """
+    def __init__(self):
+        self._postings = defaultdict(set)
+        self._grams = {}  # key -> trigrams it is listed under
+        self._texts = {}  # key -> its texts, lowercased
+        self._joined = None  # (all texts, start offset of each key, keys); built on demand
+
+    @staticmethod
+    def trigrams(text: str) -> set:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def add(self, key: str, *texts: str):
+        """Index key under the texts, replacing what it was indexed under"""
+        lowered = tuple(text.lower() if text else "" for text in texts)
+        if self._texts.get(key) == lowered:
+            return
+        self._texts[key] = lowered
+        self._joined = None
+        grams = set()
+        for text in lowered:
+            grams |= self.trigrams(text)
+        old = self._grams.get(key, set())
+        for gram in old - grams:
+            self._discard(gram, key)
+        for gram in grams - old:
+            self._postings[gram].add(key)
+        self._grams[key] = grams
+
+    def remove(self, key: str):
+        if self._texts.pop(key, None) is not None:
+            self._joined = None
+        for gram in self._grams.pop(key, ()):
+            self._discard(gram, key)
+
+    def texts(self, key: str) -> tuple:
+        """The lowercased texts key was added with"""
+        return self._texts[key]
+
+    def _discard(self, gram: str, key: str):
+        keys = self._postings[gram]
+        keys.discard(key)
+        if not keys:
+            del self._postings[gram]
+
+    def candidates(self, query: str) -> Optional[set]:
+        """Keys that may contain query (lowercased); None if it is too short to narrow down"""
+        grams = self.trigrams(query)
+        if not grams:
+            return None
+        postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def search(self, query: str) -> set:
+        """Keys with a text containing query (lowercased)"""
+        keys = self.candidates(query)
+        if keys is None:
+            return self._scan(query)
+        texts = self._texts
+        return {key for key in keys if any(query in text for text in texts[key])}
+
+    def _scan(self, query: str) -> set:
+        """Keys with a text containing query, found with str.find over the joined texts"""
+        if self._joined is None:
+            # Newlines separate texts and keys; queries are built from whitespace-split words
+            # so they never contain one, and a hit can't span two texts
+            keys = list(self._texts)
+            starts = []
+            offset = 0
+            chunks = []
+            for key in keys:
+                chunk = "\n".join(self._texts[key]) + "\n"
+                starts.append(offset)
+                chunks.append(chunk)
+                offset += len(chunk)
+            self._joined = ("".join(chunks), starts, keys)
+        joined, starts, keys = self._joined
+        hits = set()
+        i = joined.find(query)
+        while i != -1:
+            k = bisect.bisect_right(starts, i) - 1
+            hits.add(keys[k])
+            if k + 1 == len(starts):
+                break
+            i = joined.find(query, starts[k + 1])  # Skip the rest of this key's texts
+        return hits
 
 class BotDatabase:
     def __init__(self):
-        self._cache = {}
-        self._cache_timeout = 300  # 5 minutes
         self._last_save = {}
-        self.message_store = FileManager.load_data(MESSAGE_STORE_PATH)
-        self.message_batch = FileManager.load_data(MESSAGE_BATCH_PATH)
-        self.stats = FileManager.load_data(STATS_PATH, {
-            "views": {},
-            "users": {},
-            "batch_views": {},
-            "message_types": {
-                "text": 0,
-                "photo": 0,
-                "video": 0,
-                "document": 0,
-                "audio": 0,
-                "voice": 0,
-                "sticker": 0,
-                "animation": 0
-            }
-        })
-        self.batches = FileManager.load_data(BATCHES_PATH)
-        self.subscriptions = FileManager.load_data(os.path.join(DATA_DIR, "subscriptions.json"), {})
-        self.user_profiles = FileManager.load_data(os.path.join(DATA_DIR, "user_profiles.json"), {})
+        # Message keys: unique even for bursts within the same second
+        self._msg_seq = itertools.count(int(time.time() * 1000))
+        self._save_lock = threading.Lock()
+        self._dirty = set()
+        self._dirty_event = None
+        self._flusher_task = None
+        self._flusher_stopping = False  # Set by flush_now; the flusher exits after its current write
+        self._wake_timer = None  # The one pending delayed wake-up of the flusher, if any
+        self._log_fds = {}
+        self._log_lines = {}
+        self._pending_logs = {
+            MESSAGE_STORE_LOG_PATH: deque(),
+            MESSAGE_BATCH_LOG_PATH: deque(),
+            BATCHES_LOG_PATH: deque(),
+            SHARE_TOKENS_LOG_PATH: deque()
+        }
+        self._pending_compactions = {}
+        # Names of batches changed since the last flush; each is logged once per flush
+        self._dirty_batches = set()
+        self.message_store, self._log_lines[MESSAGE_STORE_LOG_PATH] = FileManager.load_log(
+            MESSAGE_STORE_LOG_PATH, MESSAGE_STORE_PATH)
+        self.message_batch, self._log_lines[MESSAGE_BATCH_LOG_PATH] = FileManager.load_log(
+            MESSAGE_BATCH_LOG_PATH, MESSAGE_BATCH_PATH)
+        # Stats are only ever incremented, so they are logged as increments (see count_stat)
+        stats, self._log_lines[STATS_LOG_PATH] = FileManager.load_counter_log(STATS_LOG_PATH, STATS_PATH)
+        # Unary + drops the counts that pruning brought down to zero
+        self.stats = {counter: +stats[counter] for counter in ("views", "users", "batch_views", "message_types")}
+        # counter -> increments not yet written to the stats log
+        self._stats_deltas = defaultdict(Counter)
+        # Set when a stats write failed: its increments are gone, so rewrite the full counts
+        self._stats_compact = False
+        self.batches, self._log_lines[BATCHES_LOG_PATH] = FileManager.load_log(
+            BATCHES_LOG_PATH, BATCHES_PATH)
+        self._key_by_casefold = {key.casefold(): key for key in self.batches}
+        # creator user_id -> batch names; derived from batches, never saved
+        self._by_creator = defaultdict(set)
+        for batch_name, batch in self.batches.items():
+            self._by_creator[batch.get("created_by")].add(batch_name)
+        # Search indexes over the fields /search and /search_batch look in; never saved
+        self.message_index = TrigramIndex()
+        for message_key, message_data in self.message_store.items():
+            self._index_message(message_key, message_data)
+        self.batch_index = TrigramIndex()
+        # Lowercased teacher names: index over the distinct names, and name -> batch names
+        self.teacher_index = TrigramIndex()
+        self._teacher_batches = defaultdict(set)
+        self._teacher_of = {}  # batch name -> its lowercased teacher name
+        self._index_batches(*self.batches)
+        self.subscriptions = FileManager.load_data(SUBSCRIPTIONS_PATH, {})
+        # user_id -> batch names; derived from subscriptions, never saved
+        self._user_to_batches = defaultdict(set)
+        for batch_name, subscribers in self.subscriptions.items():
+            for uid in subscribers:
+                self._user_to_batches[uid].add(batch_name)
+        self.user_profiles = FileManager.load_data(USER_PROFILES_PATH, {})
+        # token -> {"batch", "sharer_id", "sharer_name", "shared_at"}
+        self.share_tokens, self._log_lines[SHARE_TOKENS_LOG_PATH] = FileManager.load_log(
+            SHARE_TOKENS_LOG_PATH, SHARE_TOKENS_PATH)
+        # Older versions kept share tokens in the batch record itself; move them here
+        for batch_name, batch in self.batches.items():
+            legacy_tokens = batch.pop("share_tokens", None)
+            if legacy_tokens is None:
+                continue
+            # Plain list entries carry no sharer, and start() still resolves them by name
+            if isinstance(legacy_tokens, dict):
+                for legacy_token, info in legacy_tokens.items():
+                    token = legacy_token[len("batch_"):]
+                    if token in self.share_tokens or "shared_at" not in info:
+                        continue
+                    self.share_tokens[token] = {
+                        "batch": batch_name,
+                        "sharer_id": info.get("sharer_id"),
+                        "sharer_name": info.get("sharer_name", "Someone"),
+                        "shared_at": info["shared_at"]
+                    }
+                    self._append_log(SHARE_TOKENS_LOG_PATH, token, self.share_tokens[token])
+            self.mark_batch_dirty(batch_name)
+        # (batch, sharer_id) -> token, so sharing the same batch again reuses the link
+        self._share_token_by_sharer = {}
+        for token, info in list(self.share_tokens.items()):
+            if info.get("batch") not in self.batches:
+                # Links to deleted batches can never resolve again
+                self._drop_share_token(token)
+            else:
+                self._share_token_by_sharer[(info["batch"], info.get("sharer_id"))] = token
+
+    def _is_save_due(self, filepath: str) -> bool:
+        """Whether the save interval has passed since filepath was last written"""
+        return self._save_delay(filepath) == 0
+
+    def _save_delay(self, filepath: str) -> float:
+        """Seconds until filepath's save interval has passed, 0 if it already has"""
+        last_save = self._last_save.get(filepath)
+        if last_save is None:
+            return 0
+        return max(SAVE_INTERVALS.get(filepath, SAVE_INTERVAL) - (time.monotonic() - last_save), 0)
+
+    def _files(self) -> dict:
+        return {
+            SUBSCRIPTIONS_PATH: self.subscriptions,
+            USER_PROFILES_PATH: self.user_profiles
+        }
 
-    def _should_save(self, filepath: str) -> bool:
-        current_time = datetime.now().timestamp()
-        if filepath not in self._last_save:
-            self._last_save[filepath] = current_time
-            return True
-        if current_time - self._last_save[filepath] > 5:  # Save if more than 5 seconds passed
-            self._last_save[filepath] = current_time
-            return True
-        return False
+    def _take_snapshots(self, filepaths, force: bool = False) -> list:
+        """Shallow-copy the data of the given files that are due (or all with force) and un-dirty them.
+
+        Runs on the caller's thread so the worker never sees a dict that is
+        being mutated by a handler.
+        """
+        files = self._files()
+        with self._save_lock:
+            due = [filepath for filepath in filepaths if force or self._is_save_due(filepath)]
+            self._dirty.difference_update(due)
+            return [(filepath, self._drain_stats() if filepath == STATS_LOG_PATH else dict(files[filepath]))
+                    for filepath in due]
+
+    def _drain_stats(self) -> tuple:
+        """Take the stat increments since the last write: (compact, counts).
+
+        Once the log has LOG_COMPACT_SLACK lines, or after a failed write, the
+        full counts are taken instead, to replace it.
+        """
+        deltas = {counter: dict(counts) for counter, counts in self._stats_deltas.items() if counts}
+        self._stats_deltas.clear()
+        if not deltas and not self._stats_compact:
+            return False, deltas
+        self._log_lines[STATS_LOG_PATH] += 1
+        if self._stats_compact or self._log_lines[STATS_LOG_PATH] > LOG_COMPACT_SLACK:
+            self._stats_compact = False
+            self._log_lines[STATS_LOG_PATH] = 1
+            return True, {counter: dict(counts) for counter, counts in self.stats.items()}
+        return False, deltas
 
-    def save_all(self):
-        if self._should_save(MESSAGE_STORE_PATH):
-            FileManager.save_data(MESSAGE_STORE_PATH, self.message_store)
-        if self._should_save(MESSAGE_BATCH_PATH):
-            FileManager.save_data(MESSAGE_BATCH_PATH, self.message_batch)
-        if self._should_save(STATS_PATH):
-            FileManager.save_data(STATS_PATH, self.stats)
-        if self._should_save(BATCHES_PATH):
-            FileManager.save_data(BATCHES_PATH, self.batches)
-        if self._should_save(os.path.join(DATA_DIR, "subscriptions.json")):
-            FileManager.save_data(os.path.join(DATA_DIR, "subscriptions.json"), self.subscriptions)
-        if self._should_save(os.path.join(DATA_DIR, "user_profiles.json")):
-            FileManager.save_data(os.path.join(DATA_DIR, "user_profiles.json"), self.user_profiles)
-
-    def get_cached(self, key: str, filepath: str):
-        current_time = datetime.now().timestamp()
-        if key in self._cache:
-            timestamp, value = self._cache[key]
-            if current_time - timestamp < self._cache_timeout:
-                return value
-        return None
+    @staticmethod
+    def write_snapshots(snapshots: list) -> list:
+        """Write snapshots, returning the paths that were saved successfully"""
+        return [
+            filepath for filepath, data in snapshots
+            if (FileManager.write_counter_log(filepath, *data) if filepath == STATS_LOG_PATH
+                else FileManager.save_data(filepath, data))
+        ]
 
-    def set_cached(self, key: str, value):
-        self._cache[key] = (datetime.now().timestamp(), value)
+    def _record_saves(self, snapshots: list, saved: list):
+        """Start the save interval of written files and re-dirty the failed ones"""
+        current_time = time.monotonic()
+        for filepath in saved:
+            self._last_save[filepath] = current_time
+        failed = [filepath for filepath, _ in snapshots if filepath not in saved]
+        if STATS_LOG_PATH in failed:
+            self._stats_compact = True
+        self._dirty.update(failed)
+
+    def _log_data(self, log_path: str) -> dict:
+        if log_path == BATCHES_LOG_PATH:
+            return self.batches
+        if log_path == SHARE_TOKENS_LOG_PATH:
+            return self.share_tokens
+        return self.message_store if log_path == MESSAGE_STORE_LOG_PATH else self.message_batch
+
+    def _append_log(self, log_path: str, key: str, value):
+        """Queue one change for a log; the flusher writes queued lines together"""
+        self._log_lines[log_path] += 1
+        data = self._log_data(log_path)
+        if self._log_lines[log_path] > 2 * len(data) + LOG_COMPACT_SLACK:
+            # The snapshot already contains every queued change
+            self._log_lines[log_path] = len(data)
+            self._pending_compactions[log_path] = dict(data)
+            self._pending_logs[log_path].clear()
+        else:
+            self._pending_logs[log_path].append(FileManager.encode_line({key: value}))
+        if self._dirty_event is not None:
+            self._dirty_event.set()
+
+    def _drain_logs(self) -> dict:
+        """Take everything queued for the logs: {log_path: (compaction_snapshot, lines)}"""
+        # Batches are mutated in place, so encode their latest state only now
+        for batch_name in self._dirty_batches:
+            self._append_log(BATCHES_LOG_PATH, batch_name, self.batches.get(batch_name))
+        self._dirty_batches.clear()
+        drained = {}
+        for log_path, pending in self._pending_logs.items():
+            compaction = self._pending_compactions.pop(log_path, None)
+            if pending or compaction is not None:
+                drained[log_path] = (compaction, list(pending))
+                pending.clear()
+        return drained
+
+    def _write_logs(self, drained: dict) -> list:
+        """Write drained log changes, returning the paths whose write failed"""
+        failed = []
+        for log_path, (compaction, lines) in drained.items():
+            try:
+                if compaction is not None:
+                    FileManager.save_log(log_path, compaction)
+                    fd = self._log_fds.pop(log_path, None)
+                    if fd is not None:
+                        os.close(fd)  # Still points at the replaced file
+                if lines:
+                    fd = self._log_fds.get(log_path)
+                    if fd is None:
+                        fd = self._log_fds[log_path] = os.open(
+                            log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                    FileManager.write_vectored(fd, lines)
+                    policy = FSYNC_POLICIES.get(log_path)
+                    if policy and policy.should_sync():
+                        os.fsync(fd)
+            except Exception as e:
+                logger.error(f"Error writing {log_path}: {e}")
+                failed.append(log_path)
+                # A partial write may have left a line without its newline; don't append after it
+                fd = self._log_fds.pop(log_path, None)
+                if fd is not None:
+                    os.close(fd)
+        return failed
+
+    def _requeue_failed_logs(self, failed: list):
+        """Rewrite failed logs from memory on the next flush; their drained lines are gone"""
+        for log_path in failed:
+            data = self._log_data(log_path)
+            self._pending_logs[log_path].clear()  # Already contained in the snapshot
+            self._pending_compactions[log_path] = dict(data)
+            self._log_lines[log_path] = len(data)
+
+    def new_message_key(self) -> str:
+        return f"msg_{next(self._msg_seq)}"
+
+    def store_message(self, message_key: str, message_data: dict):
+        self.message_store[message_key] = message_data
+        self._index_message(message_key, message_data)
+        self._append_log(MESSAGE_STORE_LOG_PATH, message_key, message_data)
+
+    def _index_message(self, message_key: str, message_data: dict):
+        self.message_index.add(
+            message_key, message_data.get("text"), message_data.get("caption"), message_data.get("file_name"))
+
+    def similar_teachers(self, teacher: str, limit: int = 5) -> List[str]:
+        """Closest lowercased teacher names"""
+        return difflib.get_close_matches(teacher.lower(), self._teacher_batches.keys(), n=limit, cutoff=0.6)
+
+    def teacher_batches(self, teacher: str) -> set:
+        """Names of the batches taught by a lowercased teacher name"""
+        return self._teacher_batches.get(teacher, set())
+
+    def _index_batches(self, *batch_names: str):
+        for batch_name in batch_names:
+            batch = self.batches.get(batch_name)
+            if batch is None:
+                self.batch_index.remove(batch_name)
+            else:
+                self.batch_index.add(
+                    batch_name, batch_name, batch.get("description"), batch.get("teacher_name"))
+            teacher = batch.get("teacher_name", "").lower() if batch is not None else None
+            old_teacher = self._teacher_of.get(batch_name)
+            if teacher == old_teacher:
+                continue
+            if old_teacher is not None:
+                del self._teacher_of[batch_name]
+                taught = self._teacher_batches[old_teacher]
+                taught.discard(batch_name)
+                if not taught:
+                    del self._teacher_batches[old_teacher]
+                    self.teacher_index.remove(old_teacher)
+            if teacher is not None:
+                self._teacher_of[batch_name] = teacher
+                if teacher not in self._teacher_batches:
+                    self.teacher_index.add(teacher, teacher)
+                self._teacher_batches[teacher].add(batch_name)
+
+    def add_batch_message(self, message_key: str, message_data: dict):
+        self.message_batch[message_key] = message_data
+        self._append_log(MESSAGE_BATCH_LOG_PATH, message_key, message_data)
+
+    def get_message(self, message_key: str) -> Optional[dict]:
+        """Look a message up in both stores"""
+        message = self.message_store.get(message_key)
+        return message if message is not None else self.message_batch.get(message_key)
+
+    def count_stat(self, counter: str, key: str):
+        """Increment a stats counter and queue the increment for the stats log"""
+        self.stats[counter][key] += 1
+        self._stats_deltas[counter][key] += 1
+        self.mark_dirty(STATS_LOG_PATH)
+
+    def record_view(self, message_key: str, user_id: int):
+        """Count a view of a stored message"""
+        self.count_stat("views", message_key)
+        self.count_stat("users", str(user_id))
+
+    def remove_batch_messages(self, message_keys):
+        """Unlink many messages from their batch at once, e.g. when the batch is deleted"""
+        removed = [k for k in set(message_keys) if self.message_batch.pop(k, None) is not None]
+        # Deleted messages can't be viewed again, so their counters would only grow the stats file
+        views = self.stats["views"]
+        view_deltas = self._stats_deltas["views"]
+        for message_key in removed:
+            count = views.pop(message_key, 0)
+            if count:
+                view_deltas[message_key] -= count
+                self.mark_dirty(STATS_LOG_PATH)
+        if len(removed) > len(self.message_batch) // 4:
+            # A fresh snapshot is smaller than a tombstone per removed message
+            self._log_lines[MESSAGE_BATCH_LOG_PATH] = len(self.message_batch)
+            self._pending_compactions[MESSAGE_BATCH_LOG_PATH] = dict(self.message_batch)
+            self._pending_logs[MESSAGE_BATCH_LOG_PATH].clear()
+            if self._dirty_event is not None:
+                self._dirty_event.set()
+        else:
+            for message_key in removed:
+                self._append_log(MESSAGE_BATCH_LOG_PATH, message_key, None)
+
+    def mark_batch_dirty(self, *batch_names: str):
+        """Queue batches to be upserted (or deleted) in the batch log by the flusher"""
+        self._dirty_batches.update(batch_names)
+        # Every batch change comes through here, so this keeps the search index current
+        self._index_batches(*batch_names)
+        if self._dirty_event is not None:
+            self._dirty_event.set()
+
+    def mark_dirty(self, *filepaths: str):
+        """Queue files to be written by the background flusher"""
+        self._dirty.update(filepaths)
+        self._wake_flusher(min(map(self._save_delay, filepaths)))
+
+    def _wake_flusher(self, delay: float = 0):
+        """Wake the flusher now, or after delay; one timer serves all delayed wake-ups"""
+        if self._dirty_event is None:
+            return
+        if delay <= 0:
+            self._dirty_event.set()
+            return
+        loop = asyncio.get_running_loop()
+        when = loop.time() + delay
+        if self._wake_timer is not None:
+            if self._wake_timer.when() <= when:
+                return  # Already waking up early enough
+            self._wake_timer.cancel()
+        self._wake_timer = loop.call_at(when, self._on_wake_timer)
+
+    def _on_wake_timer(self):
+        self._wake_timer = None
+        self._dirty_event.set()
+
+    def start_flusher(self):
+        """Start the background flusher, must be called from the running event loop"""
+        self._dirty_event = asyncio.Event()
+        if (self._dirty or self._dirty_batches or any(self._pending_logs.values())
+                or self._pending_compactions):
+            self._dirty_event.set()
+        self._flusher_task = asyncio.create_task(self._flusher_loop())
+
+    async def _flusher_loop(self):
+        """Write every dirty file once per burst of changes (group commit)"""
+        loop = asyncio.get_running_loop()
+        while not self._flusher_stopping:
+            await self._dirty_event.wait()
+            if self._flusher_stopping:
+                break  # flush_now writes whatever is pending
+            await asyncio.sleep(FLUSH_GROUP_DELAY)
+            self._dirty_event.clear()
+
+            snapshots = self._take_snapshots(list(self._dirty))
+            drained = self._drain_logs()
+            if not snapshots and not drained:
+                continue
+            saved, failed_logs = [], list(drained)
+            try:
+                saved, failed_logs = await loop.run_in_executor(_io_executor, self._flush, snapshots, drained)
+            except Exception as e:
+                logger.error(f"Error flushing database: {e}")
+            self._record_saves(snapshots, saved)
+            if failed_logs:
+                self._requeue_failed_logs(failed_logs)
+                self._wake_flusher(SAVE_INTERVAL)  # Retry, e.g. once the disk has space
+
+            # Come back for files still dirty: inside their save interval, or failed
+            # to save (no delay left), which are retried after SAVE_INTERVAL
+            if self._dirty:
+                self._wake_flusher(min(map(self._save_delay, self._dirty)) or SAVE_INTERVAL)
+
+    async def flush_now(self):
+        """Stop the flusher and write everything still pending, ignoring the save interval"""
+        if self._flusher_task is not None:
+            # Not cancelled: a write in progress must finish and requeue what it failed to write
+            self._flusher_stopping = True
+            self._dirty_event.set()
+            await self._flusher_task
+            self._flusher_task = None
+        if self._wake_timer is not None:
+            self._wake_timer.cancel()
+            self._wake_timer = None
+        snapshots = self._take_snapshots(list(self._dirty), force=True)
+        drained = self._drain_logs()
+        saved, failed_logs = await asyncio.get_running_loop().run_in_executor(
+            _io_executor, self._flush, snapshots, drained)
+        self._record_saves(snapshots, saved)
+        self._requeue_failed_logs(failed_logs)
+
+    def _flush(self, snapshots: list, drained: dict) -> tuple:
+        """Write logs and snapshots: (saved snapshot paths, failed log paths)"""
+        failed_logs = self._write_logs(drained)
+        return self.write_snapshots(snapshots), failed_logs
 
     def get_batch_key(self, batch_name: str) -> str:
         """Get the actual batch key from the database, case-insensitive"""
-        batch_name = batch_name.lower()
-        for key in self.batches:
-            if key.lower() == batch_name:
-                return key
-        return batch_name
+        return self._key_by_casefold.get(batch_name.casefold(), batch_name.casefold())
+
+    def similar_batches(self, batch_name: str, limit: int = 5) -> List[str]:
+        """Closest existing batch names, matched case-insensitively"""
+        matches = difflib.get_close_matches(batch_name.casefold(), self._key_by_casefold.keys(), n=limit, cutoff=0.4)
+        return [self._key_by_casefold[match] for match in matches]
+
+    def add_batch(self, batch_name: str, batch: dict):
+        """Insert a new batch and index its name"""
+        self.batches[batch_name] = batch
+        self._key_by_casefold[batch_name.casefold()] = batch_name
+        self._by_creator[batch.get("created_by")].add(batch_name)
+        self.mark_batch_dirty(batch_name)
+
+    def remove_batch(self, batch_name: str):
+        """Delete a batch, drop it from the indexes and revoke its share links"""
+        batch = self.batches.pop(batch_name)
+        self._key_by_casefold.pop(batch_name.casefold(), None)
+        created = self._by_creator[batch.get("created_by")]
+        created.discard(batch_name)
+        if not created:
+            del self._by_creator[batch.get("created_by")]
+        self.mark_batch_dirty(batch_name)
+        for (shared_batch, _), token in list(self._share_token_by_sharer.items()):
+            if shared_batch == batch_name:
+                self._drop_share_token(token)
 
     def is_subscribed(self, user_id: int, batch_name: str) -> bool:
         """Check if a user is subscribed to a batch"""
@@ -133,15 +885,17 @@ class BotDatabase:
         if batch_name not in self.subscriptions:
             self.subscriptions[batch_name] = {}
         self.subscriptions[batch_name][str(user_id)] = datetime.now().isoformat()
-        self.save_all()
+        self._user_to_batches[str(user_id)].add(batch_name)
+        self.mark_dirty(SUBSCRIPTIONS_PATH)
 
     def unsubscribe(self, user_id: int, batch_name: str):
         """Unsubscribe a user from a batch"""
         if batch_name in self.subscriptions and str(user_id) in self.subscriptions[batch_name]:
             del self.subscriptions[batch_name][str(user_id)]
+            self._user_to_batches[str(user_id)].discard(batch_name)
             if not self.subscriptions[batch_name]:
                 del self.subscriptions[batch_name]
-            self.save_all()
+            self.mark_dirty(SUBSCRIPTIONS_PATH)
 
     def get_subscribers(self, batch_name: str) -> List[int]:
         """Get list of user IDs subscribed to a batch"""
@@ -154,95 +908,190 @@ class BotDatabase:
             "first_name": first_name,
             "last_updated": datetime.now().isoformat()
         }
-        self.save_all()
+        self.mark_dirty(USER_PROFILES_PATH)
 
     def get_user_profile(self, user_id: int) -> dict:
         """Get user profile"""
         return self.user_profiles.get(str(user_id), {})
 
+    def create_share_token(self, batch_name: str, sharer_id: int, sharer_name: str) -> str:
+        """Record who shared a batch and return the token for the share link"""
+        token = self._share_token_by_sharer.get((batch_name, sharer_id))
+        if token is not None:
+            return token
+        token = secrets.token_urlsafe(12)
+        self._share_token_by_sharer[(batch_name, sharer_id)] = token
+        self.share_tokens[token] = {
+            "batch": batch_name,
+            "sharer_id": sharer_id,
+            "sharer_name": sharer_name,
+            "shared_at": datetime.now().isoformat()
+        }
+        self._append_log(SHARE_TOKENS_LOG_PATH, token, self.share_tokens[token])
+        return token
+
+    def _drop_share_token(self, token: str):
+        info = self.share_tokens.pop(token)
+        self._share_token_by_sharer.pop((info.get("batch"), info.get("sharer_id")), None)
+        self._append_log(SHARE_TOKENS_LOG_PATH, token, None)
+
+    def get_created_batches(self, user_id: int) -> List[str]:
+        """Get all batches created by a user, by name"""
+        return sorted(self._by_creator.get(user_id, ()))
+
+    def subscribed_batches(self, user_id: int) -> set:
+        """Names of the batches the user is subscribed to; don't mutate it"""
+        return self._user_to_batches.get(str(user_id), set())
+
     def get_user_subscriptions(self, user_id: int) -> List[str]:
         """Get list of batch names the user is subscribed to"""
-        subscribed_batches = []
-        for batch_name, subscribers in self.subscriptions.items():
-            if str(user_id) in subscribers:
-                subscribed_batches.append(batch_name)
-        return subscribed_batches
+        return list(self._user_to_batches.get(str(user_id), ()))
 
 db = BotDatabase()
+_notify_semaphore = asyncio.Semaphore(NOTIFY_CONCURRENCY)
+_chat_cache = TTLCache(maxsize=1024, ttl=300)
+
+async def cached_get_chat(bot, user_id: int):
+    """bot.get_chat() with the result kept for a few minutes"""
+    chat = _chat_cache.get(user_id)
+    if chat is None:
+        chat = _chat_cache[user_id] = await bot.get_chat(user_id)
+    return chat
+
+def _is_owner(batch: dict, user_id: int) -> bool:
+    """Whether user_id may edit or delete the batch; the one place to teach about co-owners"""
+    return user_id == batch.get("created_by")
+
+DATE_FORMAT = "%B %d, %Y at %I:%M %p"
+
+@lru_cache(maxsize=4096)
+def format_date(iso_date: str) -> str:
+    """Render a stored ISO timestamp for display; a changed timestamp is a new cache key"""
+    return datetime.fromisoformat(iso_date).strftime(DATE_FORMAT)
+
+@lru_cache(maxsize=4096)
+def format_day(iso_date: str) -> str:
+    """Render a stored ISO timestamp as a day, e.g. January 01, 2024"""
+    return datetime.fromisoformat(iso_date).strftime("%B %d, %Y")
+
+try:
+    IST = ZoneInfo("Asia/Kolkata")
+except ZoneInfoNotFoundError:
+    # No tz database (e.g. Windows without tzdata); India has no DST
+    IST = timezone(timedelta(hours=5, minutes=30), "IST")
+
+@lru_cache(maxsize=4096)
+def format_date_ist(iso_date: str) -> str:
+    """Render a stored timestamp in IST; naive timestamps are the server's local time"""
+    return datetime.fromisoformat(iso_date).astimezone(IST).strftime(DATE_FORMAT + " IST")
+
+# Callback data prefixes that carry a batch name
+_CB_BACK_TO_BATCH = "back_to_batch_"
+_CB_CONFIRM_DELETE = "confirm_delete_"
+
+# Keyboards used all over the handlers; buttons are immutable so they can be shared
+BTN_BACK_TO_BATCHES = InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
+BTN_BATCH_LIST = InlineKeyboardButton("📋 Back to Batches", callback_data="cmd_listbatches")
+BTN_REFRESH_LIST = InlineKeyboardButton("🔄 Refresh List", callback_data="cmd_listbatches")
+BTN_BACK_TO_HELP = InlineKeyboardButton("🔙 Back", callback_data="cmd_help")
+KB_BACK_TO_BATCHES = InlineKeyboardMarkup([[BTN_BACK_TO_BATCHES]])
+KB_BACK_TO_LIST = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back", callback_data="cmd_listbatches")]])
+KB_BACK_TO_START = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Start", callback_data="cmd_start")]])
+KB_HELP = InlineKeyboardMarkup([[InlineKeyboardButton("📚 Help", callback_data="cmd_help")]])
+KB_BACK_TO_HELP = InlineKeyboardMarkup([[BTN_BACK_TO_HELP]])
+KB_CANCEL_TO_HELP = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data="cmd_help")]])
+KB_PROFILE = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📚 View All Batches", callback_data="cmd_listbatches")],
+    [InlineKeyboardButton("🔄 Refresh Profile", callback_data="cmd_profile")]
+])
+
+@lru_cache(maxsize=512)
+def kb_back_to_batch(batch_name: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔙 Back to Batch Info", callback_data=_CB_BACK_TO_BATCH + batch_name)
+    ]])
+
+@lru_cache(maxsize=512)
+def kb_cancel_to_batch(batch_name: str) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔙 Cancel", callback_data=_CB_BACK_TO_BATCH + batch_name)
+    ]])
+
+@lru_cache(maxsize=512)
+def _viewer_kb(batch_name: str, has_messages: bool) -> InlineKeyboardMarkup:
+    """batch_info keyboard for users other than the creator"""
+    keyboard = []
+    if has_messages:
+        keyboard.append([InlineKeyboardButton("📱 View Messages", callback_data=f"batch_{batch_name}")])
+    keyboard.append([InlineKeyboardButton("🔗 Share Batch", callback_data=f"share_{batch_name}")])
+    keyboard.append([BTN_BACK_TO_BATCHES])
+    return InlineKeyboardMarkup(keyboard)
+
+def _view_batches_kb(batch_names) -> InlineKeyboardMarkup:
+    """One View button per batch (first occurrence only), then back to the batch list"""
+    keyboard = [
+        [InlineKeyboardButton(f"📱 View {name}", callback_data=f"batch_{name}")]
+        for name in dict.fromkeys(batch_names)
+    ]
+    keyboard.append([BTN_BACK_TO_BATCHES])
+    return InlineKeyboardMarkup(keyboard)
 
-# ======================
-# Core Bot Functionality
-# ======================
-
-async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    # Check if this is a shared batch link
-    if context.args and context.args[0].startswith("batch_"):
-        share_token = context.args[0]
-        # Extract batch name and sharer info from token (format: batch_name_sharer_id_timestamp)
-        parts = share_token.split("_")
-        if len(parts) >= 3:
-            batch_name = "_".join(parts[1:-2])  # Handle batch names that might contain underscores
-            sharer_id = parts[-2]
-            
-            if batch_name in db.batches:
-                batch = db.batches[batch_name]
-                
-                # Get sharer info
-                sharer_info = None
-                if "share_tokens" in batch and share_token in batch["share_tokens"]:
-                    sharer_info = batch["share_tokens"][share_token]
-                
-                # Show batch info with sharer information
-                context.args = [batch_name]
-                
-                # If this is a shared link, show who shared it
-                if sharer_info:
-                    sharer_name = sharer_info.get("sharer_name", "Someone")
-                    shared_at = datetime.fromisoformat(sharer_info["shared_at"]).strftime("%B %d, %Y at %I:%M %p")
-                    
-                    await update.message.reply_text(
-                        f"🔗 <b>Shared Batch</b>\n\n"
-                        f"This batch was shared with you by <b>{sharer_name}</b>\n"
-                        f"Shared on: {shared_at}\n\n"
-                        f"Click below to view the batch contents:",
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup([[
-                            InlineKeyboardButton("📱 View Batch", callback_data=f"batch_{batch_name}")
-                        ]])
-                    )
-                
-                return await batch_info(update, context)
-            else:
-                await update.message.reply_text(
-                    "❌ The shared batch no longer exists or has been deleted.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Start", callback_data="cmd_start")
-                    ]])
-                )
-                return
-
-    # Regular start command
-    keyboard = [[InlineKeyboardButton("📚 Help", callback_data="cmd_help")]]
-    
-    await update.message.reply_text(
-        "🎓 <b>Welcome to Premium Batch Bot</b>\n"
-        "🤝 Powered by <b>NEELAXMI × CBSEIANSS</b>\n\n"
-        "Your all-in-one platform to access structured, high-quality educational content:\n\n"
-        "📦 <b>What You Get:</b>\n"
-        "• 🎥 Premium Video Lectures – Delivered in perfect sequence\n"
-        "• 📁 Study Files, Notes & Documents – Instantly downloadable\n"
-        "• 🗂️ Organized Course Batches – Sorted and serial-wise\n"
-        "• 🔍 Smart Search – Quickly find topics or lessons\n"
-        "• 📊 Track views, top users, and manage batches with ease\n\n"
-        "🧠 <b>Mastermind Behind This:</b> <b>Saksham</b> & <b>Tanmay</b>\n"
-        "🚀 Let's upgrade your learning experience — the premium way.\n\n"
-        "Use /help to see available commands.",
-        parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(keyboard)
-    )
+# Replies shared by the batch commands
+_CREATEBATCH_FORMAT = (
+    "Usage: /createbatch <name> <teacher_name> [description]\n"
+    "Example: /createbatch Math101 JohnSmith Math class notes"
+)
+_USAGE_CREATEBATCH = (
+    f"ℹ️ {_CREATEBATCH_FORMAT}\n\n"
+    "After creating the batch, you can add a banner picture by sending an image with caption /setbanner <batch_name>"
+)
+_ERR_CREATEBATCH_MISSING = f"❌ Error: Both batch name and teacher name are required!\n\n{_CREATEBATCH_FORMAT}"
+_ERR_CREATEBATCH_EMPTY = f"❌ Error: Batch name and teacher name cannot be empty!\n\n{_CREATEBATCH_FORMAT}"
+_ERR_CREATEBATCH_FAILED = (
+    "❌ An error occurred while creating the batch.\n"
+    f"Please try again with the correct format:\n\n{_CREATEBATCH_FORMAT}"
+)
+_USAGE_SETBANNER = "❌ Please send a photo with the caption /setbanner <batch_name>"
+_ERR_SETBANNER_NO_NAME = (
+    "❌ Please specify the batch name in the caption.\n"
+    "Example: Send a photo with caption '/setbanner Math101'"
+)
+_USAGE_ADDTOBATCH = "ℹ️ Usage: /addtobatch <name>"
+_USAGE_BATCHINFO = "ℹ️ Usage: /batchinfo <name>\nExample: /batchinfo Math101"
+_USAGE_EDITBATCH = (
+    "ℹ️ Usage: /editbatch <name> <new description>\n"
+    "Example: /editbatch MeetingNotes Updated meeting notes from today"
+)
+_ERR_BATCH_NOT_FOUND = "❌ Batch not found!"
+_ERR_BATCH_GONE = "❌ Batch no longer exists!"
+_ERR_OWNER_EDIT = "❌ Only the batch creator can edit it!"
+_ERR_OWNER_DELETE = "❌ Only the batch creator can delete it!"
+_ERR_OWNER_BANNER = "❌ Only the batch creator can set the banner!"
+_ERR_INPUT_EXPIRED = "⌛ That request expired. Please press the button again."
+_ERR_MESSAGE_GONE = "❌ Message no longer available!"
+_ERR_MESSAGE_CONTENT = "❌ Error retrieving message content. The file might have expired."
+_ERR_MESSAGE_FAILED = (
+    "❌ An error occurred while retrieving the message.\n"
+    "Please try again or contact support if the issue persists."
+)
+_BATCH_INFO_HEADER = "📱 <b>Batch Information</b>\n"  # Joined with "\n", so followed by a blank line
+
+_START_TEXT = (
+    "🎓 <b>Welcome to Premium Batch Bot</b>\n"
+    "🤝 Powered by <b>NEELAXMI × CBSEIANSS</b>\n\n"
+    "Your all-in-one platform to access structured, high-quality educational content:\n\n"
+    "📦 <b>What You Get:</b>\n"
+    "• 🎥 Premium Video Lectures – Delivered in perfect sequence\n"
+    "• 📁 Study Files, Notes & Documents – Instantly downloadable\n"
+    "• 🗂️ Organized Course Batches – Sorted and serial-wise\n"
+    "• 🔍 Smart Search – Quickly find topics or lessons\n"
+    "• 📊 Track views, top users, and manage batches with ease\n\n"
+    "🧠 <b>Mastermind Behind This:</b> <b>Saksham</b> & <b>Tanmay</b>\n"
+    "🚀 Let's upgrade your learning experience — the premium way.\n\n"
+    "Use /help to see available commands."
+)
 
-async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    help_text = """
+_HELP_TEXT = """
 📚 <b>Main Commands</b>:
 /search - Search for files (add keyword after command)
 /search_batch - Search for batches (add keyword after command)
@@ -271,233 +1120,296 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 • Voice Messages
 • Stickers & Animations
 """
-    await update.message.reply_text(help_text, parse_mode="HTML")
-
-# ==================
-# Message Management
-# ==================
-
-async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message = update.message
-    user = message.from_user
 
-    # Update user profile
-    db.update_user_profile(user.id, user.username, user.first_name)
+# The help screen reached from the start keyboard also lists /topmessages
+_HELP_MENU_TEXT = """
+📚 <b>Main Commands</b>:
+/search - Search for messages (add keyword after command)
+/search_batch - Search for message batches (add keyword after command)
+/search_teacher - Search for batches by teacher name
+/search_date - Search messages in a batch by date
+/topmessages - Most viewed messages
+/userstats - Top active users
 
-    # Show typing indicator
-    await context.bot.send_chat_action(chat_id=message.chat_id, action="typing")
+📦 <b>Batch Commands</b>:
+/createbatch - Create new message batch (add name and optional description)
+/addtobatch - Add messages to batch (add batch name)
+/listbatches - List all message batches
+/batchinfo - Get batch details (add batch name)
+/editbatch - Edit batch description (add name and new description)
+/done - Finish adding to batch
 
-    # Handle date search input
-    if 'date_search_batch' in context.user_data:
-        batch_name = context.user_data.pop('date_search_batch')
-        date_str = message.text.strip()
+💡 <b>Batch Management</b>:
+• Use /batchinfo to view batch details
+• Click "Edit Description" to modify batch info
+• Click "Delete Batch" to remove a batch
+• Only batch creators can edit or delete their batches
 
-        # Validate date format
-        try:
-            search_date = datetime.strptime(date_str, "%Y-%m-%d").date()
-        except ValueError:
-            return await message.reply_text(
-                "❌ Invalid date format!\n"
-                "Please use YYYY-MM-DD format.\n"
-                "Example: 2024-03-20\n\n"
-                "Try again or use /search_date to start over."
-            )
+📝 <b>Supported Message Types</b>:
+• Text Messages
+• Photos & Videos
+• Documents & Files
+• Voice Messages
+• Stickers & Animations
+"""
 
-        # Get batch messages
-        batch = db.batches[batch_name]
-        messages = batch.get("messages", [])
-        
-        # Filter messages by date
-        date_matches = []
-        for msg_key in messages:
-            if msg_key in db.message_batch:
-                msg = db.message_batch[msg_key]
-                msg_date = datetime.fromisoformat(msg["date"]).date()
-                if msg_date == search_date:
-                    date_matches.append((msg_key, msg))
-
-        if not date_matches:
-            return await message.reply_text(
-                f"ℹ️ No messages found in batch '{batch_name}' for date {date_str}.\n"
-                "Try a different date or use /batchinfo to see all messages.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔄 Try Another Date", callback_data=f"search_date_{batch_name}"),
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+# ======================
+# Core Bot Functionality
+# ======================
 
-        # Build message
-        msg = f"📅 <b>Messages from {date_str} in batch '{batch_name}'</b>\n\n"
-        msg += f"Found {len(date_matches)} messages:\n\n"
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Check if this is a shared batch link
+    if context.args and context.args[0].startswith("batch_"):
+        share_token = context.args[0]
+        sharer_info = db.share_tokens.get(share_token[len("batch_"):])
+        if sharer_info:
+            batch_name = sharer_info["batch"]
+        else:
+            # Links made before the token index: batch_<name>_<sharer_id>_<timestamp>
+            batch_name = "_".join(share_token.split("_")[1:-2])
 
-        # Build keyboard
-        keyboard = []
-        for msg_key, message_data in date_matches:
-            preview = message_data.get("text", message_data.get("caption", f"[{message_data['type'].upper()}]"))[:30]
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{message_data['type'].upper()}: {preview}...",
-                    callback_data=f"msg_{msg_key}"
+        if batch_name in db.batches:
+            # Show batch info with sharer information
+            context.args = [batch_name]
+            
+            # If this is a shared link, show who shared it
+            if sharer_info:
+                sharer_name = sharer_info.get("sharer_name", "Someone")
+                shared_at = datetime.fromisoformat(sharer_info["shared_at"]).strftime("%B %d, %Y at %I:%M %p")
+                
+                await update.message.reply_text(
+                    f"🔗 <b>Shared Batch</b>\n\n"
+                    f"This batch was shared with you by <b>{sharer_name}</b>\n"
+                    f"Shared on: {shared_at}\n\n"
+                    f"Click below to view the batch contents:",
+                    parse_mode="HTML",
+                    reply_markup=InlineKeyboardMarkup([[
+                        InlineKeyboardButton("📱 View Batch", callback_data=f"batch_{batch_name}")
+                    ]])
                 )
-            ])
-
-        # Add navigation buttons
-        keyboard.append([
-            InlineKeyboardButton("🔄 Search Another Date", callback_data=f"search_date_{batch_name}"),
-            InlineKeyboardButton("🔙 Back to Batch Info", callback_data=f"back_to_batch_{batch_name}")
-        ])
-        keyboard.append([InlineKeyboardButton("📋 Back to Batches", callback_data="cmd_listbatches")])
+            
+            return await batch_info(update, context)
+        else:
+            await update.message.reply_text(
+                "❌ The shared batch no longer exists or has been deleted.",
+                reply_markup=KB_BACK_TO_START
+            )
+            return
 
-        await message.reply_text(
-            msg,
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
+    # Regular start command
+    await update.message.reply_text(
+        _START_TEXT,
+        parse_mode="HTML",
+        reply_markup=KB_HELP
+    )
 
-    # Handle banner picture setting
-    if 'setting_banner' in context.user_data:
-        batch_name = context.user_data.pop('setting_banner')
-        if batch_name not in db.batches:
-            return await message.reply_text(
-                "❌ Batch no longer exists!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await update.message.reply_text(_HELP_TEXT, parse_mode="HTML")
 
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            return await message.reply_text(
-                "❌ Only the batch creator can set the banner!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+# ==================
+# Message Management
+# ==================
 
-        if not message.photo:
-            return await message.reply_text(
-                "❌ Please send a photo to set as banner!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Cancel", callback_data=f"back_to_batch_{batch_name}")
-                ]])
-            )
+async def _input_search_date(message: Message, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle the date typed after picking a batch to search"""
+    date_str = message.text.strip()
 
-        # Get the highest quality photo
-        photo = message.photo[-1]
-        batch["banner_pic"] = photo.file_id
-        db.save_all()
+    # Validate date format
+    try:
+        search_date = datetime.strptime(date_str, "%Y-%m-%d").date()
+    except ValueError:
+        return await message.reply_text(
+            "❌ Invalid date format!\n"
+            "Please use YYYY-MM-DD format.\n"
+            "Example: 2024-03-20\n\n"
+            "Try again or use /search_date to start over."
+        )
 
-        await message.reply_text(
-            f"✅ Banner picture set for batch '{batch_name}'!",
+    # Get batch messages
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await message.reply_text(_ERR_BATCH_GONE, reply_markup=KB_BACK_TO_BATCHES)
+    messages = batch.get("messages", [])
+    
+    # Filter messages by date
+    date_matches = []
+    for msg_key in messages:
+        msg = db.message_batch.get(msg_key)
+        if msg is not None:
+            msg_date = datetime.fromisoformat(msg["date"]).date()
+            if msg_date == search_date:
+                date_matches.append((msg_key, msg))
+
+    if not date_matches:
+        return await message.reply_text(
+            f"ℹ️ No messages found in batch '{batch_name}' for date {date_str}.\n"
+            "Try a different date or use /batchinfo to see all messages.",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("📱 View Batch Info", callback_data=f"back_to_batch_{batch_name}")
+                InlineKeyboardButton("🔄 Try Another Date", callback_data=f"search_date_{batch_name}"),
+                BTN_BACK_TO_BATCHES
             ]])
         )
-        return
 
-    # Handle batch description editing
-    if 'editing_batch' in context.user_data:
-        batch_name = context.user_data.pop('editing_batch')
-        if batch_name not in db.batches:
-            return await message.reply_text(
-                "❌ Batch no longer exists!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+    # Build message
+    msg = f"📅 <b>Messages from {date_str} in batch '{batch_name}'</b>\n\n"
+    msg += f"Found {len(date_matches)} messages:\n\n"
 
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            return await message.reply_text(
-                "❌ Only the batch creator can edit it!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
+    # Build keyboard
+    keyboard = []
+    for msg_key, message_data in date_matches:
+        preview = message_data.get("text", message_data.get("caption", f"[{message_data['type'].upper()}]"))[:30]
+        keyboard.append([
+            InlineKeyboardButton(
+                f"{message_data['type'].upper()}: {preview}...",
+                callback_data=f"msg_{msg_key}"
             )
+        ])
 
-        new_description = message.text.strip()
-        if not new_description:
-            return await message.reply_text(
-                "❌ Description cannot be empty! Please try again.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Cancel", callback_data=f"batch_{batch_name}")
-                ]])
-            )
+    # Add navigation buttons
+    keyboard.append([
+        InlineKeyboardButton("🔄 Search Another Date", callback_data=f"search_date_{batch_name}"),
+        InlineKeyboardButton("🔙 Back to Batch Info", callback_data=_CB_BACK_TO_BATCH + batch_name)
+    ])
+    keyboard.append([BTN_BATCH_LIST])
+
+    await message.reply_text(
+        msg,
+        parse_mode="HTML",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
+
+async def _input_banner(message: Message, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle the photo sent to become a batch banner"""
+    user = message.from_user
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await message.reply_text(_ERR_BATCH_GONE, reply_markup=KB_BACK_TO_BATCHES)
+    if not _is_owner(batch, user.id):
+        return await message.reply_text(_ERR_OWNER_BANNER, reply_markup=KB_BACK_TO_BATCHES)
+
+    if not message.photo:
+        return await message.reply_text(
+            "❌ Please send a photo to set as banner!",
+            reply_markup=kb_cancel_to_batch(batch_name)
+        )
+
+    # Get the highest quality photo
+    photo = message.photo[-1]
+    batch["banner_pic"] = photo.file_id
+    db.mark_batch_dirty(batch_name)
 
-        batch["description"] = new_description
-        db.save_all()
+    await message.reply_text(
+        f"✅ Banner picture set for batch '{batch_name}'!",
+        reply_markup=InlineKeyboardMarkup([[
+            InlineKeyboardButton("📱 View Batch Info", callback_data=_CB_BACK_TO_BATCH + batch_name)
+        ]])
+    )
 
-        await message.reply_text(
-            f"✅ Batch '{batch_name}' updated!\n"
-            f"New description: {new_description}",
+async def _input_description(message: Message, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle the new description of a batch"""
+    user = message.from_user
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await message.reply_text(_ERR_BATCH_GONE, reply_markup=KB_BACK_TO_BATCHES)
+    if not _is_owner(batch, user.id):
+        return await message.reply_text(_ERR_OWNER_EDIT, reply_markup=KB_BACK_TO_BATCHES)
+
+    new_description = message.text.strip()
+    if not new_description:
+        return await message.reply_text(
+            "❌ Description cannot be empty! Please try again.",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back to Batch Info", callback_data=f"back_to_batch_{batch_name}")
+                InlineKeyboardButton("🔙 Cancel", callback_data=f"batch_{batch_name}")
             ]])
         )
-        return
-
-    # Handle teacher name editing
-    if 'editing_teacher' in context.user_data:
-        batch_name = context.user_data.pop('editing_teacher')
-        if batch_name not in db.batches:
-            return await message.reply_text(
-                "❌ Batch no longer exists!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
 
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            return await message.reply_text(
-                "❌ Only the batch creator can edit it!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
-
-        new_teacher = message.text.strip()
-        if not new_teacher:
-            return await message.reply_text(
-                "❌ Teacher name cannot be empty! Please try again.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Cancel", callback_data=f"batch_{batch_name}")
-                ]])
-            )
+    batch["description"] = new_description
+    db.mark_batch_dirty(batch_name)
 
-        batch["teacher_name"] = new_teacher
-        db.save_all()
+    await message.reply_text(
+        f"✅ Batch '{batch_name}' updated!\n"
+        f"New description: {new_description}",
+        reply_markup=kb_back_to_batch(batch_name)
+    )
 
-        await message.reply_text(
-            f"✅ Batch '{batch_name}' updated!\n"
-            f"New teacher: {new_teacher}",
+async def _input_teacher(message: Message, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle the new teacher name of a batch"""
+    user = message.from_user
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await message.reply_text(_ERR_BATCH_GONE, reply_markup=KB_BACK_TO_BATCHES)
+    if not _is_owner(batch, user.id):
+        return await message.reply_text(_ERR_OWNER_EDIT, reply_markup=KB_BACK_TO_BATCHES)
+
+    new_teacher = message.text.strip()
+    if not new_teacher:
+        return await message.reply_text(
+            "❌ Teacher name cannot be empty! Please try again.",
             reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back to Batch Info", callback_data=f"back_to_batch_{batch_name}")
+                InlineKeyboardButton("🔙 Cancel", callback_data=f"batch_{batch_name}")
             ]])
         )
-        return
 
-    # Handle message storage
-    if 'current_batch' in context.user_data:
-        batch_name = context.user_data['current_batch']
-        await _add_to_batch(message, batch_name, context)
-    else:
-        await _store_message(message)
+    batch["teacher_name"] = new_teacher
+    db.mark_batch_dirty(batch_name)
 
-async def _store_message(message: Message):
-    message_key = f"msg_{int(datetime.now().timestamp())}"
-    message_data = await _extract_message_data(message)
+    await message.reply_text(
+        f"✅ Batch '{batch_name}' updated!\n"
+        f"New teacher: {new_teacher}",
+        reply_markup=kb_back_to_batch(batch_name)
+    )
+
+# Replies the bot is waiting for after a button press: kind -> handler(message, context, batch_name)
+PENDING_INPUT_HANDLERS = {
+    "search_date": _input_search_date,
+    "banner": _input_banner,
+    "description": _input_description,
+    "teacher": _input_teacher,
+}
+
+def _expect_input(context: ContextTypes.DEFAULT_TYPE, kind: str, batch_name: str):
+    """Route the user's next message to PENDING_INPUT_HANDLERS[kind]; replaces any earlier request"""
+    context.user_data['pending'] = (kind, batch_name, time.monotonic())
+
+async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message = update.message
+    user = message.from_user
+
+    # Update user profile
+    db.update_user_profile(user.id, user.username, user.first_name)
+
+    # A reply a button asked for; one pressed too long ago is forgotten, not stored as a message
+    pending = context.user_data.pop('pending', None)
+    if pending is not None and time.monotonic() - pending[2] > PENDING_INPUT_TTL:
+        return await message.reply_text(_ERR_INPUT_EXPIRED, reply_markup=KB_BACK_TO_BATCHES)
+
+    # Show typing indicator only for the branches that do real work, without awaiting the round-trip
+    if (pending is not None and pending[0] == "search_date") or 'current_batch' in context.user_data:
+        context.application.create_task(
+            context.bot.send_chat_action(chat_id=message.chat_id, action="typing")
+        )
+
+    if pending is not None:
+        kind, batch_name, _ = pending
+        return await PENDING_INPUT_HANDLERS[kind](message, context, batch_name)
+
+    # Handle message storage
+    if 'current_batch' in context.user_data:
+        batch_name = context.user_data['current_batch']
+        await _add_to_batch(message, batch_name, context)
+    else:
+        await _store_message(message)
+
+async def _store_message(message: Message):
+    message_key = db.new_message_key()
+    message_data = await _extract_message_data(message)
     
     if not message_data:
         return
 
     # Store message data
-    db.message_store[message_key] = message_data
-    db.stats["message_types"][message_data["type"]] = db.stats["message_types"].get(message_data["type"], 0) + 1
-    
-    # Save in background
-    asyncio.create_task(_save_db_async())
+    db.store_message(message_key, message_data)
+    db.count_stat("message_types", message_data["type"])
     
     # Send response immediately
     await message.reply_text(
@@ -506,102 +1418,82 @@ async def _store_message(message: Message):
         f"Content: {message_data.get('text', 'Media content')[:50]}..."
     )
 
+async def _notify_text(bot, user_id: int, message_data: Dict, text: str):
+    await bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
+
+async def _notify_sticker(bot, user_id: int, message_data: Dict, text: str):
+    await bot.send_sticker(chat_id=user_id, sticker=message_data["file_id"])
+    await bot.send_message(chat_id=user_id, text=text, parse_mode="HTML")
+
+def _media_notifier(method: str, file_arg: str):
+    """Build a sender that forwards a media file with the notification as caption"""
+    async def notify(bot, user_id: int, message_data: Dict, text: str):
+        await getattr(bot, method)(
+            chat_id=user_id,
+            caption=text,
+            parse_mode="HTML",
+            **{file_arg: message_data["file_id"]}
+        )
+    return notify
+
+# Message type -> (label, field shown under the header, sender for one subscriber)
+NOTIFY_DISPATCH = {
+    "text": ("message", "text", _notify_text),
+    "photo": ("photo", "caption", _media_notifier("send_photo", "photo")),
+    "video": ("video", "caption", _media_notifier("send_video", "video")),
+    "document": ("document", "caption", _media_notifier("send_document", "document")),
+    "voice": ("voice message", None, _media_notifier("send_voice", "voice")),
+    "audio": ("audio", "title", _media_notifier("send_audio", "audio")),
+    "sticker": ("sticker", None, _notify_sticker),
+    "animation": ("animation", "caption", _media_notifier("send_animation", "animation"))
+}
+
 async def _add_to_batch(message: Message, batch_name: str, context: ContextTypes.DEFAULT_TYPE = None):
     if batch_name not in db.batches:
-        await message.reply_text("❌ Batch no longer exists!")
+        await message.reply_text(_ERR_BATCH_GONE)
         return
 
-    message_key = f"msg_{int(datetime.now().timestamp())}"
+    message_key = db.new_message_key()
     message_data = await _extract_message_data(message)
     
     if not message_data:
         return
 
     # Store message data
-    db.message_batch[message_key] = {
+    db.add_batch_message(message_key, {
         **message_data,
         "batch": batch_name
-    }
+    })
+
+    batch = db.batches[batch_name]
+    batch.setdefault("messages", []).append(message_key)
+    message_types = batch.setdefault("message_types", {})
+    message_types[message_data["type"]] = message_types.get(message_data["type"], 0) + 1
 
-    if "messages" not in db.batches[batch_name]:
-        db.batches[batch_name]["messages"] = []
-    db.batches[batch_name]["messages"].append(message_key)
-    
     # Update last_updated timestamp
-    db.batches[batch_name]["last_updated"] = datetime.now().isoformat()
+    batch["last_updated"] = datetime.now().isoformat()
 
-    db.stats["message_types"][message_data["type"]] += 1
-    
-    # Save in background
-    asyncio.create_task(_save_db_async())
+    db.count_stat("message_types", message_data["type"])
+    db.mark_batch_dirty(batch_name)
     
     # Notify subscribers
     subscribers = db.get_subscribers(batch_name)
-    if subscribers and context:
-        # Send notifications to all subscribers
-        for user_id in subscribers:
-            try:
-                # Send the actual message based on its type
-                if message_data["type"] == "text":
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"🔔 <b>New message in batch '{batch_name}'</b>\n\n{message_data['text']}",
-                        parse_mode="HTML"
-                    )
-                elif message_data["type"] == "photo":
-                    await context.bot.send_photo(
-                        chat_id=user_id,
-                        photo=message_data["file_id"],
-                        caption=f"🔔 <b>New photo in batch '{batch_name}'</b>\n\n{message_data.get('caption', '')}",
-                        parse_mode="HTML"
-                    )
-                elif message_data["type"] == "video":
-                    await context.bot.send_video(
-                        chat_id=user_id,
-                        video=message_data["file_id"],
-                        caption=f"🔔 <b>New video in batch '{batch_name}'</b>\n\n{message_data.get('caption', '')}",
-                        parse_mode="HTML"
-                    )
-                elif message_data["type"] == "document":
-                    await context.bot.send_document(
-                        chat_id=user_id,
-                        document=message_data["file_id"],
-                        caption=f"🔔 <b>New document in batch '{batch_name}'</b>\n\n{message_data.get('caption', '')}",
-                        parse_mode="HTML"
-                    )
-                elif message_data["type"] == "voice":
-                    await context.bot.send_voice(
-                        chat_id=user_id,
-                        voice=message_data["file_id"],
-                        caption=f"🔔 <b>New voice message in batch '{batch_name}'</b>",
-                        parse_mode="HTML"
-                    )
-                elif message_data["type"] == "audio":
-                    await context.bot.send_audio(
-                        chat_id=user_id,
-                        audio=message_data["file_id"],
-                        caption=f"🔔 <b>New audio in batch '{batch_name}'</b>\n\n{message_data.get('title', '')}",
-                        parse_mode="HTML"
-                    )
-                elif message_data["type"] == "sticker":
-                    await context.bot.send_sticker(
-                        chat_id=user_id,
-                        sticker=message_data["file_id"]
-                    )
-                    await context.bot.send_message(
-                        chat_id=user_id,
-                        text=f"🔔 <b>New sticker in batch '{batch_name}'</b>",
-                        parse_mode="HTML"
-                    )
-                elif message_data["type"] == "animation":
-                    await context.bot.send_animation(
-                        chat_id=user_id,
-                        animation=message_data["file_id"],
-                        caption=f"🔔 <b>New animation in batch '{batch_name}'</b>\n\n{message_data.get('caption', '')}",
-                        parse_mode="HTML"
-                    )
-            except Exception as e:
-                logger.error(f"Error sending notification to user {user_id}: {e}")
+    if subscribers and context and message_data["type"] in NOTIFY_DISPATCH:
+        # Same text for every subscriber, so build it once
+        label, body_key, sender = NOTIFY_DISPATCH[message_data["type"]]
+        text = f"🔔 <b>New {label} in batch '{batch_name}'</b>"
+        if body_key:
+            text += f"\n\n{message_data.get(body_key, '')}"
+
+        async def notify(user_id: int):
+            async with _notify_semaphore:
+                try:
+                    await sender(context.bot, user_id, message_data, text)
+                except Exception as e:
+                    logger.error(f"Error sending notification to user {user_id}: {e}")
+
+        # Send notifications to all subscribers concurrently
+        await asyncio.gather(*(notify(user_id) for user_id in subscribers), return_exceptions=True)
     
     # Send response immediately
     await message.reply_text(
@@ -611,78 +1503,51 @@ async def _add_to_batch(message: Message, batch_name: str, context: ContextTypes
         "Send more messages or /done when finished."
     )
 
-async def _extract_message_data(message: Message) -> Optional[Dict]:
-    user = message.from_user
-    message_data = {
-        "type": "text",
-        "user_id": user.id,
-        "username": user.username,
-        "first_name": user.first_name,
-        "date": datetime.now().isoformat()
-    }
-
-    # Handle text messages
-    if message.text:
-        message_data["text"] = message.text
-        return message_data
-
-    # Handle photos
-    if message.photo:
-        message_data["type"] = "photo"
-        message_data["file_id"] = message.photo[-1].file_id
-        message_data["caption"] = message.caption
-        return message_data
-
-    # Handle videos
-    if message.video:
-        message_data["type"] = "video"
-        message_data["file_id"] = message.video.file_id
-        message_data["caption"] = message.caption
-        return message_data
-
-    # Handle documents
-    if message.document:
-        message_data["type"] = "document"
-        message_data["file_id"] = message.document.file_id
-        message_data["file_name"] = message.document.file_name
-        message_data["caption"] = message.caption
-        return message_data
-
-    # Handle voice messages
-    if message.voice:
-        message_data["type"] = "voice"
-        message_data["file_id"] = message.voice.file_id
-        return message_data
-
-    # Handle audio
-    if message.audio:
-        message_data["type"] = "audio"
-        message_data["file_id"] = message.audio.file_id
-        message_data["title"] = message.audio.title
-        return message_data
-
-    # Handle stickers
-    if message.sticker:
-        message_data["type"] = "sticker"
-        message_data["file_id"] = message.sticker.file_id
-        return message_data
-
-    # Handle animations
-    if message.animation:
-        message_data["type"] = "animation"
-        message_data["file_id"] = message.animation.file_id
-        message_data["caption"] = message.caption
-        return message_data
+# (attribute that must be set, extractor) in the order message types are checked; each
+# extractor builds the whole stored record in one dict literal (no merge of a base dict)
+MESSAGE_EXTRACTORS = [
+    ("text", lambda m, u, date: {
+        "type": "text", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "text": m.text
+    }),
+    ("photo", lambda m, u, date: {
+        "type": "photo", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "file_id": m.photo[-1].file_id, "caption": m.caption
+    }),
+    ("video", lambda m, u, date: {
+        "type": "video", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "file_id": m.video.file_id, "caption": m.caption
+    }),
+    ("document", lambda m, u, date: {
+        "type": "document", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "file_id": m.document.file_id, "file_name": m.document.file_name, "caption": m.caption
+    }),
+    ("voice", lambda m, u, date: {
+        "type": "voice", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "file_id": m.voice.file_id
+    }),
+    ("audio", lambda m, u, date: {
+        "type": "audio", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "file_id": m.audio.file_id, "title": m.audio.title
+    }),
+    ("sticker", lambda m, u, date: {
+        "type": "sticker", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "file_id": m.sticker.file_id
+    }),
+    ("animation", lambda m, u, date: {
+        "type": "animation", "user_id": u.id, "username": u.username, "first_name": u.first_name, "date": date,
+        "file_id": m.animation.file_id, "caption": m.caption
+    })
+]
 
+async def _extract_message_data(message: Message) -> Optional[Dict]:
+    for attribute, extract in MESSAGE_EXTRACTORS:
+        if getattr(message, attribute):
+            record = extract(message, message.from_user, datetime.now().isoformat())
+            # Unset optional fields (caption, title, username...) are left out instead of stored as null
+            return {key: value for key, value in record.items() if value is not None}
     return None
 
-async def _save_db_async():
-    """Save database changes asynchronously"""
-    try:
-        db.save_all()
-    except Exception as e:
-        logger.error(f"Error saving database: {e}")
-
 # ==================
 # Batch Management
 # ==================
@@ -690,30 +1555,18 @@ async def _save_db_async():
 async def create_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         if not context.args:
-            return await update.message.reply_text(
-                "ℹ️ Usage: /createbatch <name> <teacher_name> [description]\n"
-                "Example: /createbatch Math101 JohnSmith Math class notes\n\n"
-                "After creating the batch, you can add a banner picture by sending an image with caption /setbanner <batch_name>"
-            )
+            return await update.message.reply_text(_USAGE_CREATEBATCH)
 
         args = context.args
         if len(args) < 2:
-            return await update.message.reply_text(
-                "❌ Error: Both batch name and teacher name are required!\n\n"
-                "Usage: /createbatch <name> <teacher_name> [description]\n"
-                "Example: /createbatch Math101 JohnSmith Math class notes"
-            )
+            return await update.message.reply_text(_ERR_CREATEBATCH_MISSING)
 
         batch_name = args[0].strip()
         teacher_name = args[1].strip()
         
         # Validate batch name and teacher name
         if not batch_name or not teacher_name:
-            return await update.message.reply_text(
-                "❌ Error: Batch name and teacher name cannot be empty!\n\n"
-                "Usage: /createbatch <name> <teacher_name> [description]\n"
-                "Example: /createbatch Math101 JohnSmith Math class notes"
-            )
+            return await update.message.reply_text(_ERR_CREATEBATCH_EMPTY)
 
         description = " ".join(args[2:]).strip() if len(args) > 2 else ""
 
@@ -726,26 +1579,17 @@ async def create_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
             )
 
         # Create the batch
-        db.batches[batch_name] = {
+        now_iso = datetime.now().isoformat()
+        db.add_batch(batch_name, {
             "description": description,
             "teacher_name": teacher_name,
             "created_by": update.message.from_user.id,
-            "created_at": datetime.now().isoformat(),
-            "last_updated": datetime.now().isoformat(),  # Add last_updated field
+            "created_at": now_iso,
+            "last_updated": now_iso,  # Add last_updated field
             "messages": [],
             "banner_pic": None,  # Add banner picture field
-            "message_types": {
-                "text": 0,
-                "photo": 0,
-                "video": 0,
-                "document": 0,
-                "audio": 0,
-                "voice": 0,
-                "sticker": 0,
-                "animation": 0
-            }
-        }
-        db.save_all()
+            "message_types": dict.fromkeys(_MSG_TYPE_KEYS, 0)
+        })
 
         await update.message.reply_text(
             f"✅ Message batch '{batch_name}' created!\n"
@@ -757,50 +1601,40 @@ async def create_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     except Exception as e:
         logger.error(f"Error creating batch: {e}")
-        await update.message.reply_text(
-            "❌ An error occurred while creating the batch.\n"
-            "Please try again with the correct format:\n\n"
-            "Usage: /createbatch <name> <teacher_name> [description]\n"
-            "Example: /createbatch Math101 JohnSmith Math class notes"
-        )
+        await update.message.reply_text(_ERR_CREATEBATCH_FAILED)
 
 async def set_banner(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message.photo:
-        return await update.message.reply_text(
-            "❌ Please send a photo with the caption /setbanner <batch_name>"
-        )
+        return await update.message.reply_text(_USAGE_SETBANNER)
 
     if not context.args:
-        return await update.message.reply_text(
-            "❌ Please specify the batch name in the caption.\n"
-            "Example: Send a photo with caption '/setbanner Math101'"
-        )
+        return await update.message.reply_text(_ERR_SETBANNER_NO_NAME)
 
     batch_name = " ".join(context.args)
     actual_batch = db.get_batch_key(batch_name)
     
     if actual_batch not in db.batches:
-        return await update.message.reply_text("❌ Batch not found!")
+        return await update.message.reply_text(_ERR_BATCH_NOT_FOUND)
 
     batch = db.batches[actual_batch]
-    if update.message.from_user.id != batch["created_by"]:
-        return await update.message.reply_text("❌ Only the batch creator can set the banner!")
+    if not _is_owner(batch, update.message.from_user.id):
+        return await update.message.reply_text(_ERR_OWNER_BANNER)
 
     # Get the highest quality photo
     photo = update.message.photo[-1]
     batch["banner_pic"] = photo.file_id
-    db.save_all()
+    db.mark_batch_dirty(actual_batch)
 
     await update.message.reply_text(
         f"✅ Banner picture set for batch '{actual_batch}'!",
         reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton("📱 View Batch Info", callback_data=f"back_to_batch_{actual_batch}")
+            InlineKeyboardButton("📱 View Batch Info", callback_data=_CB_BACK_TO_BATCH + actual_batch)
         ]])
     )
 
 async def add_to_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        return await update.message.reply_text("ℹ️ Usage: /addtobatch <name>")
+        return await update.message.reply_text(_USAGE_ADDTOBATCH)
 
     batch_name = " ".join(context.args)
     actual_batch = db.get_batch_key(batch_name)
@@ -825,227 +1659,209 @@ async def done_adding(update: Update, context: ContextTypes.DEFAULT_TYPE):
         f"Use /batchinfo {batch_name} for details."
     )
 
+# batch name -> message count when its message_types were last recounted by batch_info
+_types_recounted = {}
+
 async def batch_info(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    try:
-        # Get the message object - either from direct command or callback query
-        message = update.message or update.callback_query.message
-        if not message:
-            logger.error("No message object found in update")
-            return
+    # Get the message object - either from direct command or callback query
+    message = update.message or update.callback_query.message
+    if not message:
+        logger.error("No message object found in update")
+        return
 
-        # Get batch name from args or callback data
-        batch_name = None
-        if context.args:
-            batch_name = " ".join(context.args)
-        elif update.callback_query and update.callback_query.data.startswith("back_to_batch_"):
-            batch_name = update.callback_query.data[13:].lstrip('_')
+    # Get batch name from args or callback data
+    batch_name = None
+    if context.args:
+        batch_name = " ".join(context.args)
+    elif update.callback_query and update.callback_query.data.startswith(_CB_BACK_TO_BATCH):
+        batch_name = update.callback_query.data.removeprefix(_CB_BACK_TO_BATCH)
 
-        if not batch_name:
-            if update.message:
-                await update.message.reply_text(
-                    "ℹ️ Usage: /batchinfo <name>\n"
-                    "Example: /batchinfo Math101"
-                )
-            return
+    if not batch_name:
+        if update.message:
+            await update.message.reply_text(_USAGE_BATCHINFO)
+        return
 
-        actual_batch = db.get_batch_key(batch_name)
-        if actual_batch not in db.batches:
-            # Try to find similar batch names
-            similar_batches = [
-                name for name in db.batches
-                if name.lower().startswith(batch_name.lower()) or
-                   batch_name.lower() in name.lower()
-            ][:5]
-
-            msg = f"❌ Batch '{batch_name}' not found!"
-            if similar_batches:
-                msg += "\n\nDid you mean:\n" + "\n".join(f"• {name}" for name in similar_batches)
-            
-            if update.message:
-                await update.message.reply_text(msg)
-            else:
-                await update.callback_query.edit_message_text(msg)
-            return
+    actual_batch = db.get_batch_key(batch_name)
+    if actual_batch not in db.batches:
+        # Try to find similar batch names
+        similar_batches = db.similar_batches(batch_name)
 
-        batch = db.batches[actual_batch]
+        msg = f"❌ Batch '{batch_name}' not found!"
+        if similar_batches:
+            msg += "\n\nDid you mean:\n" + "\n".join(f"• {name}" for name in similar_batches)
         
-        try:
-            creator = await context.bot.get_chat(batch["created_by"])
-        except Exception as e:
-            logger.error(f"Error getting creator info: {e}")
-            creator = None
-
-        # Count message types
-        message_types = {"text": 0, "photo": 0, "video": 0, "document": 0, 
-                        "audio": 0, "voice": 0, "sticker": 0, "animation": 0}
-        for msg_key in batch["messages"]:
-            if msg_key in db.message_batch:
-                msg_type = db.message_batch[msg_key].get("type", "text")
-                if msg_type in message_types:
-                    message_types[msg_type] += 1
-
-        # Format dates with better error handling
-        formatted_date = "Unknown"
-        formatted_last_updated = "Unknown"
+        if update.message:
+            await update.message.reply_text(msg)
+        else:
+            await update.callback_query.edit_message_text(msg)
+        return
 
-        try:
-            # Format creation date
-            if "created_at" in batch and batch["created_at"]:
-                created_at = datetime.fromisoformat(batch['created_at'])
-                formatted_date = created_at.strftime("%B %d, %Y at %I:%M %p")
-            else:
-                # If created_at is missing, try to get it from the first message
-                if batch["messages"]:
-                    first_msg_key = batch["messages"][0]
-                    if first_msg_key in db.message_batch:
-                        first_msg = db.message_batch[first_msg_key]
-                        created_at = datetime.fromisoformat(first_msg["date"])
-                        formatted_date = created_at.strftime("%B %d, %Y at %I:%M %p")
-                        # Update the batch with the correct creation date
-                        batch["created_at"] = first_msg["date"]
-                        db.save_all()
-        except Exception as e:
-            logger.error(f"Error formatting creation date: {e}")
+    batch = db.batches[actual_batch]
+    
+    try:
+        creator = await cached_get_chat(context.bot, batch["created_by"])
+    except TelegramError as e:
+        logger.error(f"Error getting creator info: {e}")
+        creator = None
+
+    # Message type counts are kept up to date by _add_to_batch
+    message_types = batch.get("message_types", {})
+    message_count = len(batch["messages"])
+    if (sum(message_types.values()) != message_count
+            and _types_recounted.get(actual_batch) != message_count):
+        # Batch from before the counts were maintained: count once and store. Keys missing
+        # from message_batch keep the sum short, so remember the recount isn't to be redone.
+        counts = Counter(
+            msg.get("type", "text")
+            for msg in map(db.message_batch.get, batch["messages"]) if msg is not None
+        )
+        recounted = {msg_type: counts[msg_type] for msg_type in _MSG_TYPE_KEYS}
+        _types_recounted[actual_batch] = message_count
+        if recounted != message_types:
+            message_types = batch["message_types"] = recounted
+            db.mark_batch_dirty(actual_batch)
 
-        try:
-            # Format last updated date
-            if "last_updated" in batch and batch["last_updated"]:
-                last_updated = datetime.fromisoformat(batch['last_updated'])
-                formatted_last_updated = last_updated.strftime("%B %d, %Y at %I:%M %p")
-            else:
-                # If last_updated is missing, try to get it from the last message
-                if batch["messages"]:
-                    last_msg_key = batch["messages"][-1]
-                    if last_msg_key in db.message_batch:
-                        last_msg = db.message_batch[last_msg_key]
-                        last_updated = datetime.fromisoformat(last_msg["date"])
-                        formatted_last_updated = last_updated.strftime("%B %d, %Y at %I:%M %p")
-                        # Update the batch with the correct last_updated date
-                        batch["last_updated"] = last_msg["date"]
-                        db.save_all()
-        except Exception as e:
-            logger.error(f"Error formatting last updated date: {e}")
-
-        # Build message
-        msg = f"📱 <b>Batch Information</b>\n\n"
-        msg += f"📚 <b>Name:</b> {actual_batch}\n"
-        msg += f"👨‍🏫 <b>Teacher:</b> {batch.get('teacher_name', 'Not specified')}\n"
-        msg += f"📝 <b>Description:</b> {batch.get('description', 'No description')}\n\n"
-        msg += f"👤 <b>Created by:</b> {creator.first_name if creator else 'Unknown'}\n"
-        msg += f"📅 <b>Created on:</b> {formatted_date}\n"
-        msg += f"🔄 <b>Last Updated:</b> {formatted_last_updated}\n"
-        msg += f"📨 <b>Total Messages:</b> {len(batch['messages'])}\n"
-        msg += f"👁️ <b>Views:</b> {db.stats['batch_views'].get(actual_batch, 0)}\n\n"
-        
-        # Add message types if there are any messages
-        if any(count > 0 for count in message_types.values()):
-            msg += f"📊 <b>Message Types:</b>\n"
-            for msg_type, count in message_types.items():
-                if count > 0:
-                    msg += f"• {msg_type.title()}: {count}\n"
-
-        # Build keyboard
+    # Format dates with better error handling
+    formatted_date = "Unknown"
+    formatted_last_updated = "Unknown"
+
+    try:
+        # Format creation date
+        if batch.get("created_at"):
+            formatted_date = format_date(batch["created_at"])
+        else:
+            # If created_at is missing, try to get it from the first message
+            if batch["messages"]:
+                first_msg = db.message_batch.get(batch["messages"][0])
+                if first_msg is not None:
+                    formatted_date = format_date(first_msg["date"])
+                    # Update the batch with the correct creation date
+                    batch["created_at"] = first_msg["date"]
+                    db.mark_batch_dirty(actual_batch)
+    except (ValueError, KeyError) as e:
+        logger.error(f"Error formatting creation date: {e}")
+
+    try:
+        # Format last updated date
+        if batch.get("last_updated"):
+            formatted_last_updated = format_date(batch["last_updated"])
+        else:
+            # If last_updated is missing, try to get it from the last message
+            if batch["messages"]:
+                last_msg = db.message_batch.get(batch["messages"][-1])
+                if last_msg is not None:
+                    formatted_last_updated = format_date(last_msg["date"])
+                    # Update the batch with the correct last_updated date
+                    batch["last_updated"] = last_msg["date"]
+                    db.mark_batch_dirty(actual_batch)
+    except (ValueError, KeyError) as e:
+        logger.error(f"Error formatting last updated date: {e}")
+
+    # Build message
+    parts = [
+        _BATCH_INFO_HEADER,
+        f"📚 <b>Name:</b> {actual_batch}",
+        f"👨‍🏫 <b>Teacher:</b> {batch.get('teacher_name', 'Not specified')}",
+        f"📝 <b>Description:</b> {batch.get('description', 'No description')}",
+        "",
+        f"👤 <b>Created by:</b> {creator.first_name if creator else 'Unknown'}",
+        f"📅 <b>Created on:</b> {formatted_date}",
+        f"🔄 <b>Last Updated:</b> {formatted_last_updated}",
+        f"📨 <b>Total Messages:</b> {len(batch['messages'])}",
+        f"👁️ <b>Views:</b> {db.stats['batch_views'].get(actual_batch, 0)}",
+        ""
+    ]
+
+    # Add message types if there are any messages
+    if any(count > 0 for count in message_types.values()):
+        parts.append("📊 <b>Message Types:</b>")
+        parts.extend(f"• {t.title()}: {c}" for t, c in message_types.items() if c > 0)
+    msg = "\n".join(parts)
+
+    # Build keyboard
+    if not _is_owner(batch, update.effective_user.id):
+        reply_markup = _viewer_kb(actual_batch, bool(batch["messages"]))
+    else:
         keyboard = []
-        
+
         # Add view messages button
         if batch["messages"]:
             keyboard.append([InlineKeyboardButton("📱 View Messages", callback_data=f"batch_{actual_batch}")])
-        
+
         # Add share button
         keyboard.append([InlineKeyboardButton("🔗 Share Batch", callback_data=f"share_{actual_batch}")])
-        
-        # Add edit buttons if user is the creator
-        if message.from_user.id == batch["created_by"]:
-            keyboard.extend([
-                [InlineKeyboardButton("✏️ Edit Description", callback_data=f"edit_desc_{actual_batch}")],
-                [InlineKeyboardButton("👨‍🏫 Edit Teacher", callback_data=f"edit_teacher_{actual_batch}")],
-                [InlineKeyboardButton("🖼️ Set Banner", callback_data=f"set_banner_{actual_batch}")],
-                [InlineKeyboardButton("🗑️ Delete Batch", callback_data=f"delete_batch_{actual_batch}")]
-            ])
+
+        # Add edit buttons, the user is the creator
+        keyboard.extend([
+            [InlineKeyboardButton("✏️ Edit Description", callback_data=f"edit_desc_{actual_batch}")],
+            [InlineKeyboardButton("👨‍🏫 Edit Teacher", callback_data=f"edit_teacher_{actual_batch}")],
+            [InlineKeyboardButton("🖼️ Set Banner", callback_data=f"set_banner_{actual_batch}")],
+            [InlineKeyboardButton("🗑️ Delete Batch", callback_data=f"delete_batch_{actual_batch}")]
+        ])
 
         # Add navigation buttons
-        keyboard.append([InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")])
+        keyboard.append([BTN_BACK_TO_BATCHES])
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
-        try:
-            # If there's a banner picture, send it as a new message
-            if batch.get("banner_pic"):
-                if update.message:
-                    await update.message.reply_photo(
-                        batch["banner_pic"],
-                        caption=msg,
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                else:
-                    await update.callback_query.message.reply_photo(
-                        batch["banner_pic"],
-                        caption=msg,
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                    # Delete the old message
-                    await update.callback_query.message.delete()
+    try:
+        # If there's a banner picture, send it as a new message
+        if batch.get("banner_pic"):
+            if update.message:
+                await update.message.reply_photo(
+                    batch["banner_pic"],
+                    caption=msg,
+                    parse_mode="HTML",
+                    reply_markup=reply_markup
+                )
             else:
-                if update.message:
-                    await update.message.reply_text(
-                        msg, 
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-                else:
-                    await update.callback_query.edit_message_text(
-                        msg,
-                        parse_mode="HTML",
-                        reply_markup=InlineKeyboardMarkup(keyboard)
-                    )
-        except Exception as e:
-            logger.error(f"Error sending/editing message: {e}")
-            # Fallback to simple text message if photo fails
+                await _replace_with_photo(update.callback_query, batch["banner_pic"], msg, reply_markup)
+        else:
             if update.message:
                 await update.message.reply_text(
-                    msg,
+                    msg, 
                     parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=reply_markup
                 )
-            else:
+            elif message.text_html != msg.strip() or message.reply_markup != reply_markup:
+                # Skip the round-trip when "Back" lands on the view that is already shown
                 await update.callback_query.edit_message_text(
                     msg,
                     parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=reply_markup
                 )
-
-    except Exception as e:
-        logger.error(f"Error in batch_info: {e}")
-        error_msg = "❌ An error occurred while fetching batch information.\nPlease try again or contact support if the issue persists."
+    except BadRequest as e:
+        logger.error(f"Error sending/editing message: {e}")
+        # Fallback to simple text message if photo fails
         if update.message:
-            await update.message.reply_text(error_msg)
-        elif update.callback_query:
-            try:
-                await update.callback_query.edit_message_text(error_msg)
-            except Exception as e:
-                logger.error(f"Error editing message: {e}")
-                await update.callback_query.message.reply_text(error_msg)
+            await update.message.reply_text(
+                msg,
+                parse_mode="HTML",
+                reply_markup=reply_markup
+            )
+        else:
+            await update.callback_query.edit_message_text(
+                msg,
+                parse_mode="HTML",
+                reply_markup=reply_markup
+            )
 
 async def edit_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        return await update.message.reply_text(
-            "ℹ️ Usage: /editbatch <name> <new description>\n"
-            "Example: /editbatch MeetingNotes Updated meeting notes from today"
-        )
+        return await update.message.reply_text(_USAGE_EDITBATCH)
 
     batch_name = context.args[0]
     actual_batch = db.get_batch_key(batch_name)
     new_description = " ".join(context.args[1:])
 
     if actual_batch not in db.batches:
-        return await update.message.reply_text("❌ Batch not found!")
+        return await update.message.reply_text(_ERR_BATCH_NOT_FOUND)
 
     batch = db.batches[actual_batch]
-    if update.message.from_user.id != batch["created_by"]:
-        return await update.message.reply_text("❌ Only the batch creator can edit it!")
+    if not _is_owner(batch, update.message.from_user.id):
+        return await update.message.reply_text(_ERR_OWNER_EDIT)
 
     batch["description"] = new_description
-    db.save_all()
+    db.mark_batch_dirty(actual_batch)
 
     await update.message.reply_text(
         f"✅ Batch '{actual_batch}' updated!\n"
@@ -1056,682 +1872,454 @@ async def edit_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Message Delivery
 # ==================
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def _reply_and_delete(query, reply) -> tuple:
+    """Await the reply coroutine while deleting the callback's message, both round-trips at once.
+
+    Returns (sent, deleted); either may be the exception it raised.
+    """
+    sent, deleted = await asyncio.gather(reply, query.message.delete(), return_exceptions=True)
+    if isinstance(deleted, Exception):
+        logger.error(f"Error deleting old message: {deleted}")
+    return sent, deleted
+
+async def _replace_with_photo(query, photo: str, caption: str, reply_markup=None, parse_mode="HTML"):
+    """Post a photo in place of the callback's message.
+
+    If the photo can't be sent (e.g. an expired banner file_id) the caption is
+    shown as text instead, as a new message when the old one is already gone.
+    """
+    sent, deleted = await _reply_and_delete(query, query.message.reply_photo(
+        photo,
+        caption=caption,
+        parse_mode=parse_mode,
+        reply_markup=reply_markup
+    ))
+    if not isinstance(sent, Exception):
+        return sent
+    logger.error(f"Error sending photo: {sent}")
+    if deleted is True:
+        return await query.message.reply_text(caption, parse_mode=parse_mode, reply_markup=reply_markup)
+    return await _safe_edit(query, caption, reply_markup=reply_markup, parse_mode=parse_mode)
+
+async def _safe_edit(query, text: str, reply_markup=None, parse_mode=None, delete_old: bool = False):
+    """Edit the callback's message, or reply if it can't be edited (e.g. it has media)"""
+    try:
+        return await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    except BadRequest:
+        reply = query.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode)
+    if delete_old:
+        sent, _ = await _reply_and_delete(query, reply)
+        if isinstance(sent, Exception):
+            raise sent
+        return sent
+    return await reply
+
+async def _deny(query, text: str):
+    """Refuse a button action"""
+    await _safe_edit(query, text, reply_markup=KB_BACK_TO_BATCHES)
+
+async def _batch_gone(query):
+    """Refuse a button for a batch that was deleted since the message was sent"""
+    await _deny(query, _ERR_BATCH_GONE)
+
+async def _cb_page(update: Update, context: ContextTypes.DEFAULT_TYPE, page_ref: str):
+    """Handle pagination, page_ref is <batch name>_<page number>"""
     query = update.callback_query
-    await query.answer()
-
-    data = query.data
-    user = query.from_user
+    batch_name, _, page = page_ref.rpartition("_")
+    try:
+        page = int(page)
+    except ValueError as e:
+        logger.error(f"Error handling pagination: {e}")
+        return await query.edit_message_text(
+            "❌ Error navigating pages.\n"
+            "Please try again or contact support if the issue persists.",
+            reply_markup=KB_BACK_TO_BATCHES
+        )
+    return await _show_batch_messages(query, batch_name, query.from_user, page)
 
-    # Handle search date batch selection
-    if data.startswith("search_date_"):
-        batch_name = data[12:]  # Remove "search_date_" prefix
-        if batch_name not in db.batches:
-            return await query.edit_message_text(
-                "❌ Batch no longer exists!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back", callback_data="cmd_help")
-                ]])
-            )
+async def _cb_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle batch selection"""
+    query = update.callback_query
+    return await _show_batch_messages(query, batch_name, query.from_user, 0)  # Start from page 0
 
-        # Store selected batch in user data
-        context.user_data['date_search_batch'] = batch_name
-        
-        # Ask for date input
-        await query.edit_message_text(
-            f"📅 <b>Searching messages in batch '{batch_name}'</b>\n\n"
-            "Please enter the date in YYYY-MM-DD format.\n"
-            "Example: 2024-03-20\n\n"
-            "Or click Cancel to go back.",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("❌ Cancel", callback_data="cmd_help")
-            ]])
-        )
-        return
+async def _cb_message(update: Update, context: ContextTypes.DEFAULT_TYPE, message_key: str):
+    """Handle message view"""
+    query = update.callback_query
+    return await _show_message(query, message_key, query.from_user)
 
-    # Handle help command
-    if data == "cmd_help":
-        help_text = """
-📚 <b>Main Commands</b>:
-/search - Search for messages (add keyword after command)
-/search_batch - Search for message batches (add keyword after command)
-/search_teacher - Search for batches by teacher name
-/search_date - Search messages in a batch by date
-/topmessages - Most viewed messages
-/userstats - Top active users
+async def _cb_search_date(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle search date batch selection"""
+    query = update.callback_query
+    if batch_name not in db.batches:
+        return await query.edit_message_text(_ERR_BATCH_GONE, reply_markup=KB_BACK_TO_HELP)
 
-📦 <b>Batch Commands</b>:
-/createbatch - Create new message batch (add name and optional description)
-/addtobatch - Add messages to batch (add batch name)
-/listbatches - List all message batches
-/batchinfo - Get batch details (add batch name)
-/editbatch - Edit batch description (add name and new description)
-/done - Finish adding to batch
+    # Store selected batch in user data
+    _expect_input(context, "search_date", batch_name)
+    
+    # Ask for date input
+    await query.edit_message_text(
+        f"📅 <b>Searching messages in batch '{batch_name}'</b>\n\n"
+        "Please enter the date in YYYY-MM-DD format.\n"
+        "Example: 2024-03-20\n\n"
+        "Or click Cancel to go back.",
+        parse_mode="HTML",
+        reply_markup=KB_CANCEL_TO_HELP
+    )
 
-💡 <b>Batch Management</b>:
-• Use /batchinfo to view batch details
-• Click "Edit Description" to modify batch info
-• Click "Delete Batch" to remove a batch
-• Only batch creators can edit or delete their batches
+async def _cb_help(update: Update, context: ContextTypes.DEFAULT_TYPE, _: str):
+    """Handle help command"""
+    query = update.callback_query
+    await query.edit_message_text(_HELP_MENU_TEXT, parse_mode="HTML", reply_markup=KB_BACK_TO_START)
 
-📝 <b>Supported Message Types</b>:
-• Text Messages
-• Photos & Videos
-• Documents & Files
-• Voice Messages
-• Stickers & Animations
-"""
-        keyboard = [[InlineKeyboardButton("🔙 Back to Start", callback_data="cmd_start")]]
-        await query.edit_message_text(help_text, parse_mode="HTML", reply_markup=InlineKeyboardMarkup(keyboard))
-        return
+async def _cb_start(update: Update, context: ContextTypes.DEFAULT_TYPE, _: str):
+    """Handle back to start"""
+    query = update.callback_query
+    await query.edit_message_text(
+        _START_TEXT,
+        parse_mode="HTML",
+        reply_markup=KB_HELP
+    )
 
-    # Handle back to start
-    if data == "cmd_start":
-        keyboard = [[InlineKeyboardButton("📚 Help", callback_data="cmd_help")]]
-        await query.edit_message_text(
-            "🎓 <b>Welcome to Premium Batch Bot</b>\n"
-            "🤝 Powered by <b>NEELAXMI × CBSEIANSS</b>\n\n"
-            "Your all-in-one platform to access structured, high-quality educational content:\n\n"
-            "📦 <b>What You Get:</b>\n"
-            "• 🎥 Premium Video Lectures – Delivered in perfect sequence\n"
-            "• 📁 Study Files, Notes & Documents – Instantly downloadable\n"
-            "• 🗂️ Organized Course Batches – Sorted and serial-wise\n"
-            "• 🔍 Smart Search – Quickly find topics or lessons\n"
-            "• 📊 Track views, top users, and manage batches with ease\n\n"
-            "🧠 <b>Mastermind Behind This:</b> <b>Saksham</b> & <b>Tanmay</b>\n"
-            "🚀 Let's upgrade your learning experience — the premium way.\n\n"
-            "Use /help to see available commands.",
-            parse_mode="HTML",
-            reply_markup=InlineKeyboardMarkup(keyboard)
-        )
-        return
+async def _cb_edit_desc(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle batch editing"""
+    query = update.callback_query
+    user = query.from_user
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await _batch_gone(query)
+    if not _is_owner(batch, user.id):
+        return await _deny(query, _ERR_OWNER_EDIT)
+    _expect_input(context, "description", batch_name)
+    await _safe_edit(
+        query,
+        f"✏️ Editing description for batch '{batch_name}'\n"
+        f"Current description: {batch.get('description', 'No description')}\n\n"
+        "Please send the new description in your next message.",
+        reply_markup=kb_cancel_to_batch(batch_name)
+    )
 
-    # Handle pagination
-    if data.startswith("page_"):
-        try:
-            # Format: page_batchname_pagenumber
-            parts = data.split("_")
-            batch_name = "_".join(parts[1:-1])  # Handle batch names that might contain underscores
-            page = int(parts[-1])
-            return await _show_batch_messages(query, batch_name, user, page)
-        except Exception as e:
-            logger.error(f"Error handling pagination: {e}")
-            return await query.edit_message_text(
-                "❌ Error navigating pages.\n"
-                "Please try again or contact support if the issue persists.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+async def _cb_edit_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle teacher name editing"""
+    query = update.callback_query
+    user = query.from_user
+    logger.info(f"Editing teacher for batch: {batch_name}")
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        logger.error(f"Batch not found: {batch_name}")
+        return await _batch_gone(query)
+    if not _is_owner(batch, user.id):
+        return await _deny(query, _ERR_OWNER_EDIT)
+    _expect_input(context, "teacher", batch_name)
+    await _safe_edit(
+        query,
+        f"👨‍🏫 Editing teacher name for batch '{batch_name}'\n"
+        f"Current teacher: {batch.get('teacher_name', 'Not specified')}\n\n"
+        "Please send the new teacher name in your next message.",
+        reply_markup=kb_cancel_to_batch(batch_name)
+    )
 
-    # Handle batch selection
-    if data.startswith("batch_"):
-        batch_name = data[6:].lstrip('_')  # Remove "batch_" prefix and any leading underscore
-        if data == "batch_info":  # Special case for back to batch info
-            return await batch_info(update, context)
-        return await _show_batch_messages(query, batch_name, user, 0)  # Start from page 0
+async def _cb_set_banner(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle set banner button"""
+    query = update.callback_query
+    user = query.from_user
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await _batch_gone(query)
+    if not _is_owner(batch, user.id):
+        return await _deny(query, _ERR_OWNER_BANNER)
+
+    _expect_input(context, "banner", batch_name)
+    await query.edit_message_text(
+        f"🖼️ Please send a photo to set as banner for batch '{batch_name}'.\n"
+        "The photo should be clear and representative of the batch content.",
+        reply_markup=kb_cancel_to_batch(batch_name)
+    )
 
-    # Handle message view
-    if data.startswith("msg_"):
-        message_key = data[4:]
-        return await _show_message(query, message_key, user)
+def _sub_button(batch_name: str, subscribed: bool) -> InlineKeyboardButton:
+    """Subscribe/unsubscribe toggle shown next to a batch in the batch list"""
+    if subscribed:
+        return InlineKeyboardButton("🔕 Unsubscribe", callback_data=f"unsub_{batch_name}")
+    return InlineKeyboardButton("🔔 Subscribe", callback_data=f"sub_{batch_name}")
 
-    # Handle batch editing
-    if data.startswith("edit_desc_"):
-        batch_name = data[10:].lstrip('_')  # Remove "edit_desc_" prefix and any leading underscore
-        if batch_name not in db.batches:
-            try:
-                await query.edit_message_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            try:
-                await query.edit_message_text(
-                    "❌ Only the batch creator can edit it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                await query.message.reply_text(
-                    "❌ Only the batch creator can edit it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
-        context.user_data['editing_batch'] = batch_name
+async def _toggle_sub_button(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str, subscribed: bool):
+    """Flip the pressed subscription button in place instead of re-rendering the batch list"""
+    query = update.callback_query
+    pressed = query.data
+    markup = query.message.reply_markup if query.message else None
+    if markup is not None:
+        keyboard = [
+            [_sub_button(batch_name, subscribed) if button.callback_data == pressed else button
+             for button in row]
+            for row in markup.inline_keyboard
+        ]
         try:
-            await query.edit_message_text(
-                f"✏️ Editing description for batch '{batch_name}'\n"
-                f"Current description: {batch.get('description', 'No description')}\n\n"
-                "Please send the new description in your next message.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Cancel", callback_data=f"back_to_batch_{batch_name}")
-                ]])
-            )
-        except Exception as e:
-            await query.message.reply_text(
-                f"✏️ Editing description for batch '{batch_name}'\n"
-                f"Current description: {batch.get('description', 'No description')}\n\n"
-                "Please send the new description in your next message.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Cancel", callback_data=f"back_to_batch_{batch_name}")
-                ]])
-            )
-        return
+            return await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard))
+        except BadRequest as e:
+            logger.error(f"Error updating subscription button: {e}")
+    return await list_batches(update, context)
 
-    # Handle teacher name editing
-    if data.startswith("edit_teacher_"):
-        batch_name = data[12:].lstrip('_')  # Remove "edit_teacher_" prefix and any leading underscore
-        logger.info(f"Editing teacher for batch: {batch_name}")
-        if batch_name not in db.batches:
-            logger.error(f"Batch not found: {batch_name}")
-            try:
-                await query.edit_message_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                await query.message.reply_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            try:
-                await query.edit_message_text(
-                    "❌ Only the batch creator can edit it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                await query.message.reply_text(
-                    "❌ Only the batch creator can edit it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
-        context.user_data['editing_teacher'] = batch_name
-        try:
-            await query.edit_message_text(
-                f"👨‍🏫 Editing teacher name for batch '{batch_name}'\n"
-                f"Current teacher: {batch.get('teacher_name', 'Not specified')}\n\n"
-                "Please send the new teacher name in your next message.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Cancel", callback_data=f"back_to_batch_{batch_name}")
-                ]])
-            )
-        except Exception as e:
-            await query.message.reply_text(
-                f"👨‍🏫 Editing teacher name for batch '{batch_name}'\n"
-                f"Current teacher: {batch.get('teacher_name', 'Not specified')}\n\n"
-                "Please send the new teacher name in your next message.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Cancel", callback_data=f"back_to_batch_{batch_name}")
-                ]])
-            )
-        return
+async def _cb_subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle subscription"""
+    query = update.callback_query
+    user = query.from_user
+    if batch_name in db.batches:
+        db.subscribe(user.id, batch_name)
+        await _toggle_sub_button(update, context, batch_name, subscribed=True)
+        await query.answer("✅ Subscribed to batch notifications!", show_alert=True)
 
-    # Handle set banner button
-    if data.startswith("set_banner_"):
-        batch_name = data[11:].lstrip('_')  # Remove "set_banner_" prefix
-        if batch_name not in db.batches:
-            return await query.edit_message_text(
-                "❌ Batch no longer exists!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
-        
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            return await query.edit_message_text(
-                "❌ Only the batch creator can set the banner!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+async def _cb_unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle unsubscription"""
+    query = update.callback_query
+    user = query.from_user
+    if batch_name in db.batches:
+        db.unsubscribe(user.id, batch_name)
+        await _toggle_sub_button(update, context, batch_name, subscribed=False)
+        await query.answer("✅ Unsubscribed from batch notifications!", show_alert=True)
 
-        context.user_data['setting_banner'] = batch_name
-        await query.edit_message_text(
-            f"🖼️ Please send a photo to set as banner for batch '{batch_name}'.\n"
-            "The photo should be clear and representative of the batch content.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Cancel", callback_data=f"back_to_batch_{batch_name}")
-            ]])
+async def _cb_confirm_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle batch deletion confirmation"""
+    query = update.callback_query
+    user = query.from_user
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await _batch_gone(query)
+    if not _is_owner(batch, user.id):
+        return await _deny(query, _ERR_OWNER_DELETE)
+
+    try:
+        # Delete batch and its messages
+        db.remove_batch_messages(batch.get("messages", ()))
+        db.remove_batch(batch_name)
+        _viewer_kb.cache_clear()
+
+        await _safe_edit(
+            query,
+            f"✅ Batch '{batch_name}' has been deleted!",
+            reply_markup=KB_BACK_TO_BATCHES
+        )
+    except Exception as e:
+        logger.error(f"Error deleting batch: {e}")
+        await _safe_edit(
+            query,
+            "❌ Error deleting batch. Please try again.",
+            reply_markup=KB_BACK_TO_BATCHES
         )
-        return
 
-    # Handle subscription
-    if data.startswith("sub_"):
-        batch_name = data[4:]
-        if batch_name in db.batches:
-            db.subscribe(user.id, batch_name)
-            await query.answer("✅ Subscribed to batch notifications!", show_alert=True)
-            # Refresh the batch list
-            return await list_batches(update, context)
-        return
+async def _cb_delete_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle batch deletion request"""
+    query = update.callback_query
+    user = query.from_user
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await _batch_gone(query)
+    if not _is_owner(batch, user.id):
+        return await _deny(query, _ERR_OWNER_DELETE)
 
-    # Handle unsubscription
-    if data.startswith("unsub_"):
-        batch_name = data[6:]
-        if batch_name in db.batches:
-            db.unsubscribe(user.id, batch_name)
-            await query.answer("✅ Unsubscribed from batch notifications!", show_alert=True)
-            # Refresh the batch list
-            return await list_batches(update, context)
-        return
+    # Show confirmation dialog
+    keyboard = [
+        [
+            InlineKeyboardButton("✅ Yes, Delete", callback_data=_CB_CONFIRM_DELETE + batch_name),
+            InlineKeyboardButton("❌ No, Cancel", callback_data=_CB_BACK_TO_BATCH + batch_name)
+        ]
+    ]
+    
+    await _safe_edit(
+        query,
+        f"⚠️ Are you sure you want to delete batch '{batch_name}'?\n"
+        f"This will delete all messages in this batch and cannot be undone!",
+        reply_markup=InlineKeyboardMarkup(keyboard)
+    )
 
-    # Handle list batches command
-    if data == "cmd_listbatches":
-        return await list_batches(update, context)
+async def _cb_back_to_batch(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle back to batch info"""
+    query = update.callback_query
+    if batch_name not in db.batches:
+        return await _batch_gone(query)
+    return await batch_info(update, context)
 
-    # Handle batch deletion confirmation
-    if data.startswith("confirm_delete_"):
-        batch_name = data[14:].lstrip('_')  # Remove "confirm_delete_" prefix and any leading underscore
-        if batch_name not in db.batches:
-            try:
-                await query.edit_message_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
-        
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            try:
-                await query.edit_message_text(
-                    "❌ Only the batch creator can delete it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    "❌ Only the batch creator can delete it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
+async def _cb_profile(update: Update, context: ContextTypes.DEFAULT_TYPE, _: str):
+    """Handle profile command"""
+    query = update.callback_query
+    user = query.from_user
+    msg = _profile_text(user)
+    await _safe_edit(
+        query,
+        msg,
+        parse_mode="HTML",
+        reply_markup=KB_PROFILE,
+        delete_old=True
+    )
 
-        try:
-            # Delete batch and its messages
-            for msg_key in batch.get("messages", []):
-                if msg_key in db.message_batch:
-                    del db.message_batch[msg_key]
-            del db.batches[batch_name]
-            db.save_all()
+async def _cb_share(update: Update, context: ContextTypes.DEFAULT_TYPE, batch_name: str):
+    """Handle share button"""
+    query = update.callback_query
+    batch = db.batches.get(batch_name)
+    if batch is None:
+        return await _batch_gone(query)
 
-            try:
-                await query.edit_message_text(
-                    f"✅ Batch '{batch_name}' has been deleted!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    f"✅ Batch '{batch_name}' has been deleted!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-        except Exception as e:
-            logger.error(f"Error deleting batch: {e}")
-            try:
-                await query.edit_message_text(
-                    "❌ Error deleting batch. Please try again.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    "❌ Error deleting batch. Please try again.",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
+    # Generate a unique share token with sharer info
+    share_token = "batch_" + db.create_share_token(
+        batch_name, query.from_user.id, query.from_user.first_name
+    )
 
-    # Handle batch deletion request
-    if data.startswith("delete_batch_"):
-        batch_name = data[12:].lstrip('_')  # Remove "delete_batch_" prefix and any leading underscore
-        if batch_name not in db.batches:
-            try:
-                await query.edit_message_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
-        
-        batch = db.batches[batch_name]
-        if user.id != batch["created_by"]:
-            try:
-                await query.edit_message_text(
-                    "❌ Only the batch creator can delete it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    "❌ Only the batch creator can delete it!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
+    # Create the share link
+    share_link = f"https://t.me/{context.bot.username}?start={share_token}"
 
-        # Show confirmation dialog
-        keyboard = [
-            [
-                InlineKeyboardButton("✅ Yes, Delete", callback_data=f"confirm_delete_{batch_name}"),
-                InlineKeyboardButton("❌ No, Cancel", callback_data=f"back_to_batch_{batch_name}")
-            ]
-        ]
-        
-        try:
-            await query.edit_message_text(
-                f"⚠️ Are you sure you want to delete batch '{batch_name}'?\n"
-                f"This will delete all messages in this batch and cannot be undone!",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except Exception as e:
-            # If editing fails (e.g., message has media), send a new message
-            await query.message.reply_text(
-                f"⚠️ Are you sure you want to delete batch '{batch_name}'?\n"
-                f"This will delete all messages in this batch and cannot be undone!",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
+    # Get batch info
+    teacher = batch.get("teacher_name", "Not specified")
+    msg_count = len(batch.get("messages", []))
+    description = batch.get("description", "No description")
+
+    # Create message with batch info and share link
+    msg = f"🔗 <b>Share Batch</b>\n\n"
+    msg += f"📚 <b>Batch:</b> {batch_name}\n"
+    msg += f"👨‍🏫 <b>Teacher:</b> {teacher}\n"
+    msg += f"📝 <b>Description:</b> {description}\n"
+    msg += f"📨 <b>Messages:</b> {msg_count}\n\n"
+    msg += f"🔗 <b>Share Link:</b>\n<code>{share_link}</code>\n\n"
+    msg += "Click the link above to share this batch with others.\n"
+    msg += "The link will give access to view all messages in this batch."
 
-    # Handle back to batch info
-    if data.startswith("back_to_batch_"):
-        batch_name = data[13:].lstrip('_')  # Remove "back_to_batch_" prefix
-        if batch_name not in db.batches:
-            try:
-                await query.edit_message_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await query.message.reply_text(
-                    "❌ Batch no longer exists!",
-                    reply_markup=InlineKeyboardMarkup([[
-                        InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                    ]])
-                )
-            return
-        return await batch_info(update, context)
-    
-    # Handle profile command
-    if data == "cmd_profile":
-        # Update user profile
-        db.update_user_profile(user.id, user.username, user.first_name)
-        
-        # Get user profile and subscriptions
-        profile = db.get_user_profile(user.id)
-        subscribed_batches = db.get_user_subscriptions(user.id)
-        
-        # Build profile message
-        msg = f"👤 <b>User Profile</b>\n\n"
-        msg += f"🆔 <b>User ID:</b> {user.id}\n"
-        msg += f"👤 <b>Name:</b> {user.first_name}\n"
-        if user.username:
-            msg += f"📝 <b>Username:</b> @{user.username}\n"
-        
-        # Add subscription information
-        if subscribed_batches:
-            msg += f"\n📚 <b>Subscribed Batches ({len(subscribed_batches)}):</b>\n"
-            for batch_name in subscribed_batches:
-                if batch_name in db.batches:
-                    batch = db.batches[batch_name]
-                    msg += f"• {batch_name} ({len(batch['messages'])} messages)\n"
-        else:
-            msg += "\n📚 <b>No subscribed batches</b>\n"
-            msg += "Use /listbatches to discover and subscribe to batches!"
-        
-        # Add stats if available
-        user_views = db.stats["users"].get(str(user.id), 0)
-        if user_views > 0:
-            msg += f"\n📊 <b>Total Views:</b> {user_views}\n"
-        
-        # Create keyboard
-        keyboard = [
-            [InlineKeyboardButton("📚 View All Batches", callback_data="cmd_listbatches")],
-            [InlineKeyboardButton("🔄 Refresh Profile", callback_data="cmd_profile")]
-        ]
-        
-        try:
-            await query.edit_message_text(
-                msg,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        except Exception as e:
-            # If editing fails (e.g., message has media), send a new message
-            await query.message.reply_text(
-                msg,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            try:
-                await query.message.delete()
-            except Exception as e:
-                logger.error(f"Error deleting old message: {e}")
+    # Create keyboard
+    keyboard = [
+        [InlineKeyboardButton("📱 View Batch", callback_data=f"batch_{batch_name}")],
+        [InlineKeyboardButton("🔙 Back to Batch Info", callback_data=_CB_BACK_TO_BATCH + batch_name)]
+    ]
 
-    # Handle share button
-    if data.startswith("share_"):
-        batch_name = data[6:].lstrip('_')  # Remove "share_" prefix
-        if batch_name not in db.batches:
-            return await query.edit_message_text(
-                "❌ Batch no longer exists!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+    # If there's a banner picture, send it with the share message
+    if batch.get("banner_pic"):
+        await _replace_with_photo(query, batch["banner_pic"], msg, InlineKeyboardMarkup(keyboard))
+    else:
+        await query.edit_message_text(
+            msg,
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
 
-        # Generate a unique share token with sharer info
-        sharer_id = query.from_user.id
-        sharer_name = query.from_user.first_name
-        share_token = f"batch_{batch_name}_{sharer_id}_{int(datetime.now().timestamp())}"
+# Buttons whose callback data is a fixed token
+CALLBACK_COMMANDS = {
+    "cmd_help": _cb_help,
+    "cmd_start": _cb_start,
+    "cmd_listbatches": lambda update, context, _: list_batches(update, context),
+    "cmd_profile": _cb_profile,
+    "batch_info": lambda update, context, _: batch_info(update, context),
+}
+
+# Buttons whose callback data is <prefix><argument>
+CALLBACK_PREFIXES = {
+    "search_date_": _cb_search_date,
+    "page_": _cb_page,
+    "batch_": _cb_batch,
+    "msg_": _cb_message,
+    "edit_desc_": _cb_edit_desc,
+    "edit_teacher_": _cb_edit_teacher,
+    "set_banner_": _cb_set_banner,
+    "sub_": _cb_subscribe,
+    "unsub_": _cb_unsubscribe,
+    _CB_CONFIRM_DELETE: _cb_confirm_delete,
+    "delete_batch_": _cb_delete_batch,
+    _CB_BACK_TO_BATCH: _cb_back_to_batch,
+    "share_": _cb_share,
+}
+_CB_RE = re.compile(
+    "^(" + "|".join(map(re.escape, sorted(CALLBACK_PREFIXES, key=len, reverse=True))) + ")(.*)$",
+    re.DOTALL
+)
 
-        # Store the share token and sharer info in the batch data
-        if "share_tokens" not in db.batches[batch_name]:
-            db.batches[batch_name]["share_tokens"] = {}
-        
-        db.batches[batch_name]["share_tokens"][share_token] = {
-            "sharer_id": sharer_id,
-            "sharer_name": sharer_name,
-            "shared_at": datetime.now().isoformat()
-        }
-        db.save_all()
-
-        # Create the share link
-        share_link = f"https://t.me/{context.bot.username}?start={share_token}"
-
-        # Get batch info
-        batch = db.batches[batch_name]
-        teacher = batch.get("teacher_name", "Not specified")
-        msg_count = len(batch.get("messages", []))
-        description = batch.get("description", "No description")
-
-        # Create message with batch info and share link
-        msg = f"🔗 <b>Share Batch</b>\n\n"
-        msg += f"📚 <b>Batch:</b> {batch_name}\n"
-        msg += f"👨‍🏫 <b>Teacher:</b> {teacher}\n"
-        msg += f"📝 <b>Description:</b> {description}\n"
-        msg += f"📨 <b>Messages:</b> {msg_count}\n\n"
-        msg += f"🔗 <b>Share Link:</b>\n<code>{share_link}</code>\n\n"
-        msg += "Click the link above to share this batch with others.\n"
-        msg += "The link will give access to view all messages in this batch."
-
-        # Create keyboard
-        keyboard = [
-            [InlineKeyboardButton("📱 View Batch", callback_data=f"batch_{batch_name}")],
-            [InlineKeyboardButton("🔙 Back to Batch Info", callback_data=f"back_to_batch_{batch_name}")]
-        ]
+def _match_callback(data: str):
+    """Find the handler for callback data and the argument to pass it"""
+    handler = CALLBACK_COMMANDS.get(data)
+    if handler is not None:
+        return handler, ""
+    m = _CB_RE.match(data)
+    if m is None:
+        return None, None
+    return CALLBACK_PREFIXES[m.group(1)], m.group(2)
 
-        # If there's a banner picture, send it with the share message
-        if batch.get("banner_pic"):
-            await query.message.reply_photo(
-                batch["banner_pic"],
-                caption=msg,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-            # Delete the old message
-            await query.message.delete()
-        else:
-            await query.edit_message_text(
-                msg,
-                parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
-            )
-        return
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    await query.answer()
+
+    handler, arg = _match_callback(query.data)
+    if handler is not None:
+        await handler(update, context, arg)
+
+# Field shown in a message's list button, by message type
+_PREVIEW_FIELDS = {
+    "TEXT": "text",
+    "PHOTO": "caption",
+    "VIDEO": "caption",
+    "DOCUMENT": "caption",
+    "ANIMATION": "caption",
+    "AUDIO": "title",
+}
+
+def _message_button_text(msg: dict) -> str:
+    """Label of a message's button in the batch message list"""
+    msg_type = msg.get("type", "unknown").upper()
+    field = _PREVIEW_FIELDS.get(msg_type)
+    value = msg.get(field) if field else None
+    preview = str(value)[:30] if value else f"[{msg_type}]"
+    return f"{msg_type}: {preview}... (by {msg.get('first_name', 'Unknown')})"
+
+MESSAGES_PER_PAGE = 8
+
+@lru_cache(maxsize=1024)
+def _batch_messages_header(batch_name: str, teacher: str, description: str,
+                           message_count: int, last_date: Optional[str]) -> str:
+    """Header of the batch message list without the page line; any edit changes the cache key"""
+    header_msg = f"📱 <b>Messages in '{batch_name}'</b>\n"
+    header_msg += f"👨‍🏫 Teacher: {teacher}\n"
+    header_msg += f"📝 Description: {description}\n"
+    if last_date:
+        try:
+            header_msg += f"⏰ Last Updated: {format_date_ist(last_date)}\n"
+        except Exception as e:
+            logger.error(f"Error getting last message time: {e}")
+    header_msg += f"📨 Total messages: {message_count}\n"
+    return header_msg
 
 async def _show_batch_messages(query, batch_name: str, user, page: int = 0):
     try:
-        if batch_name not in db.batches:
-            return await query.edit_message_text(
-                "❌ Batch no longer exists!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-                ]])
-            )
+        batch = db.batches.get(batch_name)
+        if batch is None:
+            return await query.edit_message_text(_ERR_BATCH_GONE, reply_markup=KB_BACK_TO_BATCHES)
 
-        messages = db.batches[batch_name]["messages"]
+        messages = batch["messages"]
         if not messages:
             return await query.edit_message_text(
                 "ℹ️ This batch is empty.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back to Batch Info", callback_data=f"back_to_batch_{batch_name}")
-                ]])
+                reply_markup=kb_back_to_batch(batch_name)
             )
 
         # Track batch view
-        db.stats["batch_views"][batch_name] = db.stats["batch_views"].get(batch_name, 0) + 1
-        db.save_all()
-
-        # Get batch info for the header
-        batch = db.batches[batch_name]
-        
-        # Format last updated date
-        try:
-            last_updated = datetime.fromisoformat(batch['last_updated'])
-            formatted_last_updated = last_updated.strftime("%B %d, %Y at %I:%M %p")
-        except Exception as e:
-            logger.error(f"Error formatting last updated date: {e}")
-            formatted_last_updated = "Unknown"
+        db.count_stat("batch_views", batch_name)
 
         # Get last message timestamp
-        last_message_time = None
-        try:
-            if messages:
-                last_msg_key = messages[-1]
-                if last_msg_key in db.message_batch:
-                    last_msg = db.message_batch[last_msg_key]
-                    last_message_time = datetime.fromisoformat(last_msg["date"])
-                    # Convert to IST (UTC+5:30)
-                    last_message_time = last_message_time.replace(tzinfo=None) + timedelta(hours=5, minutes=30)
-                    last_message_time = last_message_time.strftime("%B %d, %Y at %I:%M %p IST")
-        except Exception as e:
-            logger.error(f"Error getting last message time: {e}")
-
-        header_msg = f"📱 <b>Messages in '{batch_name}'</b>\n"
-        header_msg += f"👨‍🏫 Teacher: {batch.get('teacher_name', 'Not specified')}\n"
-        header_msg += f"📝 Description: {batch.get('description', 'No description')}\n"
-        # header_msg += f"🔄 Last Updated: {formatted_last_updated}\n"
-        if last_message_time:
-            header_msg += f"⏰ Last Updated: {last_message_time}\n"
-        header_msg += f"📨 Total messages: {len(messages)}\n"
+        last_date = None
+        last_msg = db.message_batch.get(messages[-1])
+        if last_msg is not None:
+            last_date = last_msg.get("date")
+
+        header_msg = _batch_messages_header(
+            batch_name, batch.get('teacher_name', 'Not specified'),
+            batch.get('description', 'No description'), len(messages), last_date
+        )
 
         # Pagination settings
-        MESSAGES_PER_PAGE = 8
         total_pages = (len(messages) + MESSAGES_PER_PAGE - 1) // MESSAGES_PER_PAGE
         start_idx = page * MESSAGES_PER_PAGE
         end_idx = min(start_idx + MESSAGES_PER_PAGE, len(messages))
-        
+
         # Add page info to header
         header_msg += f"📄 Page {page + 1} of {total_pages}\n"
 
-        keyboard = []
-        for msg_key in messages[start_idx:end_idx]:
-            if msg_key in db.message_batch:
-                msg = db.message_batch[msg_key]
-                msg_type = msg.get("type", "unknown").upper()
-                
-                # Get preview text based on message type
-                preview = ""
-                if msg_type == "TEXT":
-                    preview = str(msg.get("text", ""))[:30]
-                elif msg_type in ["PHOTO", "VIDEO", "DOCUMENT", "ANIMATION"]:
-                    caption = msg.get("caption")
-                    preview = str(caption)[:30] if caption else f"[{msg_type}]"
-                elif msg_type == "AUDIO":
-                    title = msg.get("title")
-                    preview = str(title)[:30] if title else f"[{msg_type}]"
-                else:
-                    preview = f"[{msg_type}]"
-                
-                # Add sender name to preview
-                sender = msg.get("first_name", "Unknown")
-                button_text = f"{msg_type}: {preview}... (by {sender})"
-                keyboard.append([
-                    InlineKeyboardButton(
-                        button_text,
-                        callback_data=f"msg_{msg_key}"
-                    )
-                ])
+        message_batch = db.message_batch
+        keyboard = [
+            [InlineKeyboardButton(_message_button_text(msg), callback_data=f"msg_{msg_key}")]
+            for msg_key in messages[start_idx:end_idx]
+            if (msg := message_batch.get(msg_key)) is not None
+        ]
 
         # Add navigation buttons
         nav_buttons = []
@@ -1748,28 +2336,22 @@ async def _show_batch_messages(query, batch_name: str, user, page: int = 0):
 
         # Add back buttons
         nav_buttons.append([
-            InlineKeyboardButton("🔙 Back to Batch Info", callback_data=f"back_to_batch_{batch_name}"),
-            InlineKeyboardButton("📋 Back to Batches", callback_data="cmd_listbatches")
+            InlineKeyboardButton("🔙 Back to Batch Info", callback_data=_CB_BACK_TO_BATCH + batch_name),
+            BTN_BATCH_LIST
         ])
 
         keyboard.extend(nav_buttons)
+        reply_markup = InlineKeyboardMarkup(keyboard)
 
         try:
             # If there's a banner picture, send it as a new message
             if batch.get("banner_pic"):
-                await query.message.reply_photo(
-                    batch["banner_pic"],
-                    caption=header_msg,
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                # Delete the old message
-                await query.message.delete()
+                await _replace_with_photo(query, batch["banner_pic"], header_msg, reply_markup)
             else:
                 await query.edit_message_text(
                     header_msg,
                     parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
+                    reply_markup=reply_markup
                 )
         except Exception as e:
             logger.error(f"Error sending/editing message: {e}")
@@ -1777,7 +2359,7 @@ async def _show_batch_messages(query, batch_name: str, user, page: int = 0):
             await query.edit_message_text(
                 header_msg,
                 parse_mode="HTML",
-                reply_markup=InlineKeyboardMarkup(keyboard)
+                reply_markup=reply_markup
             )
 
     except Exception as e:
@@ -1785,30 +2367,74 @@ async def _show_batch_messages(query, batch_name: str, user, page: int = 0):
         await query.edit_message_text(
             "❌ An error occurred while fetching messages.\n"
             "Please try again or contact support if the issue persists.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")
-            ]])
+            reply_markup=KB_BACK_TO_BATCHES
         )
 
+_VIEW_FOOTER = "\n\n👤 From: {first_name}\n⏱️ This message will be deleted in 5 minutes"
+
+# type -> (Message reply method, text/caption template filled from the stored message)
+VIEW_SENDERS = {
+    "text": ("reply_text", "📝 {text}" + _VIEW_FOOTER),
+    "photo": ("reply_photo", "📸 {caption}" + _VIEW_FOOTER),
+    "video": ("reply_video", "🎥 {caption}" + _VIEW_FOOTER),
+    "document": ("reply_document", "📄 {file_name}\n{caption}" + _VIEW_FOOTER),
+    "voice": ("reply_voice", "🎤 Voice Message" + _VIEW_FOOTER),
+    "audio": ("reply_audio", "🎵 {title}" + _VIEW_FOOTER),
+    "sticker": ("reply_sticker", None),
+    "animation": ("reply_animation", "🎬 {caption}" + _VIEW_FOOTER),
+}
+
+class _ViewFields(dict):
+    """Stored message fields for VIEW_SENDERS templates; optional fields render empty"""
+    def __missing__(self, key):
+        return "Audio" if key == "title" else ""
+
+# message key -> (stored message, rendered view text); popular messages are viewed over and over
+_view_text_cache = TTLCache(maxsize=1024, ttl=3600)
+
+def _render_view(message_key: str, message_data: Dict, template: str) -> str:
+    cached = _view_text_cache.get(message_key)
+    # Identity check, so a message stored again under the same key is rendered afresh
+    if cached is not None and cached[0] is message_data:
+        return cached[1]
+    text = template.format_map(_ViewFields(message_data))
+    _view_text_cache[message_key] = (message_data, text)
+    return text
+
+async def _send_stored_message(message: Message, message_key: str, message_data: Dict) -> Optional[Message]:
+    """Reply to message with a stored message; None if its type is unknown"""
+    sender = VIEW_SENDERS.get(message_data["type"])
+    if sender is None:
+        return None
+    method, template = sender
+    reply = getattr(message, method)
+    if template is None:
+        return await reply(message_data["file_id"])
+    text = _render_view(message_key, message_data, template)
+    if method == "reply_text":
+        return await reply(text)
+    return await reply(message_data["file_id"], caption=text)
+
+# (user id, message key) of recent views; a double tap on a message button sends it only once
+_recent_views = TTLCache(maxsize=10_000, ttl=2)
+
+async def _message_error(query, text: str):
+    """Replace the message list with an error about the tapped message"""
+    await query.edit_message_text(text, reply_markup=KB_BACK_TO_LIST)
+
 async def _show_message(query, message_key: str, user):
+    view = (user.id, message_key)
+    if view in _recent_views:
+        return  # The callback was already answered by handle_callback
+    _recent_views[view] = True
     try:
         # Check both message stores
-        if message_key in db.message_store:
-            message_data = db.message_store[message_key]
-        elif message_key in db.message_batch:
-            message_data = db.message_batch[message_key]
-        else:
-            return await query.edit_message_text(
-                "❌ Message no longer available!",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back", callback_data="cmd_listbatches")
-                ]])
-            )
+        message_data = db.get_message(message_key)
+        if message_data is None:
+            return await _message_error(query, _ERR_MESSAGE_GONE)
 
         # Track view stats
-        db.stats["views"][message_key] = db.stats["views"].get(message_key, 0) + 1
-        db.stats["users"][str(user.id)] = db.stats["users"].get(str(user.id), 0) + 1
-        db.save_all()
+        db.record_view(message_key, user.id)
 
         # Store the original message ID for cleanup
         original_message_id = query.message.message_id
@@ -1816,127 +2442,73 @@ async def _show_message(query, message_key: str, user):
 
         try:
             # Send the message based on its type
-            if message_data["type"] == "text":
-                sent_message = await query.message.reply_text(
-                    f"📝 {message_data['text']}\n\n"
-                    f"👤 From: {message_data['first_name']}\n"
-                    f"⏱️ This message will be deleted in 5 minutes"
-                )
-                sent_messages.append(sent_message)
-            elif message_data["type"] == "photo":
-                    sent_message = await query.message.reply_photo(
-                        message_data["file_id"],
-                        caption=f"📸 {message_data.get('caption', '')}\n\n"
-                               f"👤 From: {message_data['first_name']}\n"
-                               f"⏱️ This message will be deleted in 5 minutes"
-                    )
-                    sent_messages.append(sent_message)
-            elif message_data["type"] == "video":
-                    sent_message = await query.message.reply_video(
-                        message_data["file_id"],
-                        caption=f"🎥 {message_data.get('caption', '')}\n\n"
-                               f"👤 From: {message_data['first_name']}\n"
-                               f"⏱️ This message will be deleted in 5 minutes"
-                    )
-                    sent_messages.append(sent_message)
-            elif message_data["type"] == "document":
-                    sent_message = await query.message.reply_document(
-                        message_data["file_id"],
-                        caption=f"📄 {message_data.get('file_name', '')}\n"
-                               f"{message_data.get('caption', '')}\n\n"
-                               f"👤 From: {message_data['first_name']}\n"
-                               f"⏱️ This message will be deleted in 5 minutes"
-                    )
-                    sent_messages.append(sent_message)
-            elif message_data["type"] == "voice":
-                    sent_message = await query.message.reply_voice(
-                        message_data["file_id"],
-                        caption=f"🎤 Voice Message\n\n"
-                               f"👤 From: {message_data['first_name']}\n"
-                               f"⏱️ This message will be deleted in 5 minutes"
-                    )
-                    sent_messages.append(sent_message)
-            elif message_data["type"] == "audio":
-                    sent_message = await query.message.reply_audio(
-                        message_data["file_id"],
-                        caption=f"🎵 {message_data.get('title', 'Audio')}\n\n"
-                               f"👤 From: {message_data['first_name']}\n"
-                               f"⏱️ This message will be deleted in 5 minutes"
-                    )
-                    sent_messages.append(sent_message)
-            elif message_data["type"] == "sticker":
-                sent_message = await query.message.reply_sticker(
-                    message_data["file_id"]
-                )
+            sent_message = await _send_stored_message(query.message, message_key, message_data)
+            if sent_message is not None:
                 sent_messages.append(sent_message)
-            elif message_data["type"] == "animation":
-                    sent_message = await query.message.reply_animation(
-                        message_data["file_id"],
-                        caption=f"🎬 {message_data.get('caption', '')}\n\n"
-                               f"👤 From: {message_data['first_name']}\n"
-                               f"⏱️ This message will be deleted in 5 minutes"
-                    )
-                    sent_messages.append(sent_message)
-
-            # Store message IDs for cleanup
-            message_ids = {
-                'original': original_message_id,
-                'sent': [msg.message_id for msg in sent_messages],
-                'chat_id': query.message.chat_id
-            }
-
-            # Start cleanup task
-            asyncio.create_task(_cleanup_messages(message_ids))
+
+            # Delete the reply and the original after VIEW_TTL
+            _schedule_cleanup(
+                query.message.chat_id,
+                [msg.message_id for msg in sent_messages] + [original_message_id]
+            )
 
         except Exception as e:
             logger.error(f"Error sending message: {e}")
-            await query.edit_message_text(
-                "❌ Error retrieving message content. The file might have expired.",
-                reply_markup=InlineKeyboardMarkup([[
-                    InlineKeyboardButton("🔙 Back", callback_data="cmd_listbatches")
-                ]])
-            )
+            await _message_error(query, _ERR_MESSAGE_CONTENT)
 
     except Exception as e:
         logger.error(f"Error in _show_message: {e}")
-        await query.edit_message_text(
-            "❌ An error occurred while retrieving the message.\n"
-            "Please try again or contact support if the issue persists.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back", callback_data="cmd_listbatches")
-            ]])
-        )
+        await _message_error(query, _ERR_MESSAGE_FAILED)
 
-async def _cleanup_messages(message_ids: dict):
-    """Clean up messages after 5 minutes"""
-    try:
-        # Wait for 5 minutes
-        await asyncio.sleep(300)  # 300 seconds = 5 minutes
-        
-        # Get the bot instance
-        bot = Application.get_current().bot
-        
-        # Delete all related messages
-        for msg_id in message_ids['sent']:
-            try:
-                await bot.delete_message(
-                    chat_id=message_ids['chat_id'],
-                    message_id=msg_id
-                )
-            except Exception as e:
-                logger.error(f"Error deleting sent message {msg_id}: {e}")
-        
-        # Delete the original message
+async def _delete_messages(bot, chat_id: int, message_ids: List[int]):
+    """Delete messages in one deleteMessages call, or concurrently on older PTB versions"""
+    if hasattr(bot, "delete_messages"):
         try:
-            await bot.delete_message(
-                chat_id=message_ids['chat_id'],
-                message_id=message_ids['original']
-            )
-        except Exception as e:
-            logger.error(f"Error deleting original message: {e}")
-            
-    except Exception as e:
-        logger.error(f"Error in cleanup task: {e}")
+            await bot.delete_messages(chat_id=chat_id, message_ids=message_ids)
+        except TelegramError as e:
+            logger.error(f"Error deleting messages {message_ids}: {e}")
+        return
+    results = await asyncio.gather(
+        *(bot.delete_message(chat_id=chat_id, message_id=msg_id) for msg_id in message_ids),
+        return_exceptions=True
+    )
+    for msg_id, result in zip(message_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Error deleting message {msg_id}: {result}")
+
+# Pending view cleanups: (due monotonic time, sequence, chat_id, message_ids)
+_expiry_heap = []
+_expiry_seq = itertools.count()
+_expiry_event = asyncio.Event()
+
+def _schedule_cleanup(chat_id: int, message_ids: List[int]):
+    """Have the cleanup reaper delete the messages VIEW_TTL seconds from now"""
+    heapq.heappush(_expiry_heap, (time.monotonic() + VIEW_TTL, next(_expiry_seq), chat_id, message_ids))
+    _expiry_event.set()
+
+async def _cleanup_reaper(bot):
+    """Delete viewed messages as they expire; one task sleeps until the earliest is due"""
+    while True:
+        timeout = max(_expiry_heap[0][0] - time.monotonic(), 0) if _expiry_heap else None
+        _expiry_event.clear()
+        if timeout != 0:
+            try:
+                await asyncio.wait_for(_expiry_event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        now = time.monotonic()
+        due = defaultdict(list)
+        while _expiry_heap and _expiry_heap[0][0] <= now:
+            _, _, chat_id, message_ids = heapq.heappop(_expiry_heap)
+            due[chat_id].extend(message_ids)
+        for chat_id, message_ids in due.items():
+            # deleteMessages takes at most 100 IDs
+            for i in range(0, len(message_ids), 100):
+                try:
+                    await _delete_messages(bot, chat_id, message_ids[i:i + 100])
+                except Exception as e:
+                    logger.error(f"Error in cleanup task: {e}")
 
 # ==================
 # Statistics
@@ -1946,46 +2518,40 @@ async def top_messages(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not db.stats["views"]:
         return await update.message.reply_text("ℹ️ No message data yet.")
 
-    top = sorted(
-        db.stats["views"].items(),
-        key=lambda x: x[1],
-        reverse=True
-    )[:10]
+    top = db.stats["views"].most_common(10)
 
-    msg = "🏆 <b>Top 10 Messages</b>:\n\n"
+    lines = ["🏆 <b>Top 10 Messages</b>:\n"]
     for i, (msg_key, count) in enumerate(top):
-        if msg_key in db.message_store:
-            message = db.message_store[msg_key]
-        elif msg_key in db.message_batch:
-            message = db.message_batch[msg_key]
-        else:
+        message = db.get_message(msg_key)
+        if message is None:
             continue
 
         preview = message.get("text", f"[{message['type'].upper()}]")[:30]
-        msg += f"{i+1}. {preview}... - {count} views\n"
+        lines.append(f"{i+1}. {preview}... - {count} views")
 
-    await update.message.reply_text(msg, parse_mode="HTML")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
 async def user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not db.stats["users"]:
         return await update.message.reply_text("ℹ️ No user data yet.")
 
-    top_users = sorted(
-        db.stats["users"].items(),
-        key=lambda x: x[1],
-        reverse=True
-    )[:10]
+    top_users = db.stats["users"].most_common(10)
 
-    msg = "🏆 <b>Top 10 Users</b>:\n\n"
-    for i, (user_id, count) in enumerate(top_users):
-        try:
-            user = await context.bot.get_chat(int(user_id))
+    # Look all users up at once; failures come back as exceptions
+    chats = await asyncio.gather(
+        *(cached_get_chat(context.bot, int(user_id)) for user_id, _ in top_users),
+        return_exceptions=True
+    )
+
+    lines = ["🏆 <b>Top 10 Users</b>:\n"]
+    for i, ((user_id, count), user) in enumerate(zip(top_users, chats)):
+        if isinstance(user, Exception):
+            lines.append(f"{i+1}. User {user_id} - {count} views")
+        else:
             name = user.username or user.first_name
-            msg += f"{i+1}. @{name} - {count} views\n"
-        except:
-            msg += f"{i+1}. User {user_id} - {count} views\n"
+            lines.append(f"{i+1}. @{name} - {count} views")
 
-    await update.message.reply_text(msg, parse_mode="HTML")
+    await update.message.reply_text("\n".join(lines), parse_mode="HTML")
 
 # ==================
 # Search Functionality
@@ -1997,12 +2563,8 @@ async def search(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     query = " ".join(context.args).lower()
     # Search in both message stores
-    normal_results = {
-        k: v for k, v in db.message_store.items()
-        if ("text" in v and query in v["text"].lower()) or
-           ("caption" in v and query in v["caption"].lower()) or
-           ("file_name" in v and query in v["file_name"].lower())
-    }
+    # Keys are msg_<milliseconds>, so sorting them keeps the oldest first
+    normal_results = {k: db.message_store[k] for k in sorted(db.message_index.search(query))}
 
     if not normal_results:
         return await update.message.reply_text("🔍 No messages found. Try /search_batch for messages in batches.")
@@ -2036,37 +2598,23 @@ async def search_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = " ".join(context.args).lower()
 
     # Search in batch names, descriptions, and teacher names
-    matches = {
-        name: data for name, data in db.batches.items()
-        if query in name.lower() or
-           query in data.get("description", "").lower() or
-           query in data.get("teacher_name", "").lower()
-    }
+    matches = {name: db.batches[name] for name in sorted(db.batch_index.search(query))}
 
     if not matches:
-        # Suggest similar
-        suggestions = []
-        for name, data in db.batches.items():
-            teacher = data.get("teacher_name", "").lower()
-            desc = data.get("description", "").lower()
-            if (query in name.lower() or
-                query in teacher or
-                query in desc):
-                suggestions.append((name, data))
-        
-        suggestions = sorted(suggestions, key=lambda x: (
-            query in x[0].lower(),  # Exact batch name match first
-            query in x[1].get("teacher_name", "").lower(),  # Then teacher name match
-            query in x[1].get("description", "").lower()  # Then description match
-        ), reverse=True)[:5]
+        # Nothing contains the query, so suggest close spellings: batch names first, then teachers
+        suggestions = list(dict.fromkeys(
+            db.similar_batches(query)
+            + [name for teacher in db.similar_teachers(query) for name in sorted(db.teacher_batches(teacher))]
+        ))[:5]
 
-        msg = "🔍 No exact matches found."
+        parts = ["🔍 No exact matches found."]
         if suggestions:
-            msg += "\n\nDid you mean:\n"
-            for name, data in suggestions:
-                teacher = data.get("teacher_name", "Not specified")
-                msg += f"• {name} (Teacher: {teacher})\n"
-        return await update.message.reply_text(msg)
+            parts.append("\n\nDid you mean:\n")
+            parts.extend(
+                f"• {name} (Teacher: {db.batches[name].get('teacher_name', 'Not specified')})\n"
+                for name in suggestions
+            )
+        return await update.message.reply_text("".join(parts))
 
     # Group matches by type (batch name, teacher, description)
     batch_name_matches = []
@@ -2077,58 +2625,33 @@ async def search_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
         teacher = data.get("teacher_name", "Not specified")
         msg_count = len(data.get("messages", []))
         entry = (name, teacher, msg_count)
+        name_lc, _, teacher_lc = db.batch_index.texts(name)
         
-        if query in name.lower():
+        if query in name_lc:
             batch_name_matches.append(entry)
-        elif query in teacher.lower():
+        elif query in teacher_lc:
             teacher_matches.append(entry)
         else:
             desc_matches.append(entry)
 
-    # Build the message
-    msg = "🔍 Search Results:\n\n"
-    
-    if batch_name_matches:
-        msg += "📚 <b>Batch Name Matches:</b>\n"
-        for name, teacher, count in batch_name_matches:
-            msg += f"• {name} (Teacher: {teacher}, Messages: {count})\n"
-        msg += "\n"
-    
-    if teacher_matches:
-        msg += "👨‍🏫 <b>Teacher Name Matches:</b>\n"
-        for name, teacher, count in teacher_matches:
-            msg += f"• {name} (Teacher: {teacher}, Messages: {count})\n"
-        msg += "\n"
-    
-    if desc_matches:
-        msg += "📝 <b>Description Matches:</b>\n"
-        for name, teacher, count in desc_matches:
-            msg += f"• {name} (Teacher: {teacher}, Messages: {count})\n"
-
-    # Build keyboard
-    keyboard = []
-    # Create a set to avoid duplicate buttons
-    added_batches = set()
-    
-    # Add buttons for all matches
-    for match_list in [batch_name_matches, teacher_matches, desc_matches]:
-        for name, _, _ in match_list:
-            if name not in added_batches:
-                keyboard.append([
-                    InlineKeyboardButton(
-                        f"📱 View {name}",
-                        callback_data=f"batch_{name}"
-                    )
-                ])
-                added_batches.add(name)
-
-    # Add back button
-    keyboard.append([InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")])
-
+    # Build the message, one section per kind of match
+    parts = ["🔍 Search Results:\n\n"]
+    for title, entries in (("📚 <b>Batch Name Matches:</b>", batch_name_matches),
+                           ("👨‍🏫 <b>Teacher Name Matches:</b>", teacher_matches),
+                           ("📝 <b>Description Matches:</b>", desc_matches)):
+        if entries:
+            parts.append(title + "\n")
+            parts.extend(f"• {name} (Teacher: {teacher}, Messages: {count})\n" for name, teacher, count in entries)
+            parts.append("\n")
+    msg = "".join(parts)
+
+    keyboard = _view_batches_kb(
+        name for match_list in (batch_name_matches, teacher_matches, desc_matches) for name, _, _ in match_list
+    )
     await update.message.reply_text(
         msg,
         parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=keyboard
     )
 
 async def search_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2142,24 +2665,19 @@ async def search_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # Search for batches by teacher name
     matches = {
-        name: data for name, data in db.batches.items()
-        if query in data.get("teacher_name", "").lower()
+        name: db.batches[name]
+        for teacher in db.teacher_index.search(query) for name in db.teacher_batches(teacher)
     }
 
     if not matches:
-        # Try to find similar teacher names
-        similar_teachers = set()
-        for data in db.batches.values():
-            teacher = data.get("teacher_name", "").lower()
-            if any(word in teacher for word in query.split()):
-                similar_teachers.add(teacher)
-
-        msg = f"👨‍🏫 No batches found for teacher '{query}'."
+        # Try to find similar teacher names, closest first
+        similar_teachers = db.similar_teachers(query)
+
+        parts = [f"👨‍🏫 No batches found for teacher '{query}'."]
         if similar_teachers:
-            msg += "\n\nSimilar teacher names found:\n"
-            for teacher in sorted(similar_teachers)[:5]:
-                msg += f"• {teacher}\n"
-        return await update.message.reply_text(msg)
+            parts.append("\n\nSimilar teacher names found:\n")
+            parts.extend(f"• {teacher}\n" for teacher in similar_teachers)
+        return await update.message.reply_text("".join(parts))
 
     # Sort matches by number of messages
     sorted_matches = sorted(
@@ -2169,33 +2687,22 @@ async def search_teacher(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     # Build the message
-    msg = f"👨‍🏫 <b>Batches by Teacher</b>\n\n"
+    parts = ["👨‍🏫 <b>Batches by Teacher</b>\n\n"]
     for name, data in sorted_matches:
-        teacher = data.get("teacher_name", "Not specified")
         msg_count = len(data.get("messages", []))
-        created_at = datetime.fromisoformat(data['created_at']).strftime("%B %d, %Y")
-        msg += f"📚 <b>{name}</b>\n"
-        msg += f"• Messages: {msg_count}\n"
-        msg += f"• Created: {created_at}\n"
-        msg += f"• Description: {data.get('description', 'No description')}\n\n"
-
-    # Build keyboard
-    keyboard = []
-    for name, _ in sorted_matches:
-        keyboard.append([
-            InlineKeyboardButton(
-                f"📱 View {name}",
-                callback_data=f"batch_{name}"
-            )
-        ])
-
-    # Add back button
-    keyboard.append([InlineKeyboardButton("🔙 Back to Batches", callback_data="cmd_listbatches")])
+        created_at = format_day(data['created_at'])
+        parts.append(
+            f"📚 <b>{name}</b>\n"
+            f"• Messages: {msg_count}\n"
+            f"• Created: {created_at}\n"
+            f"• Description: {data.get('description', 'No description')}\n\n"
+        )
+    msg = "".join(parts)
 
     await update.message.reply_text(
         msg,
         parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=_view_batches_kb(name for name, _ in sorted_matches)
     )
 
 async def list_batches(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2219,41 +2726,18 @@ async def list_batches(update: Update, context: ContextTypes.DEFAULT_TYPE):
         msg += "Click on a batch to view its contents.\n"
         msg += "Use 🔔 to subscribe for notifications when new contents are added.\n\n"
 
-        # Create keyboard with batch buttons
-        keyboard = []
-        current_row = []
-        
-        for name, data in batches:
-            teacher = data.get("teacher_name", "Not specified")
-            msg_count = len(data["messages"])
-            button_text = f"📚 {name} ({msg_count})"
-            
-            # Add batch button to current row
-            current_row.append(InlineKeyboardButton(
-                button_text,
-                callback_data=f"batch_{name}"
-            ))
-            
-            # Add subscribe/unsubscribe button
-            user_id = update.effective_user.id
-            is_subscribed = db.is_subscribed(user_id, name)
-            sub_button = InlineKeyboardButton(
-                "🔔 Subscribe" if not is_subscribed else "🔕 Unsubscribe",
-                callback_data=f"sub_{name}" if not is_subscribed else f"unsub_{name}"
-            )
-            current_row.append(sub_button)
-            
-            # If row is full (2 batch buttons), add row to keyboard
-            if len(current_row) == 2:
-                keyboard.append(current_row)
-                current_row = []
-
-        # Add any remaining buttons
-        if current_row:
-            keyboard.append(current_row)
+        # One row per batch: the batch button and its subscribe/unsubscribe button
+        subscribed = db.subscribed_batches(update.effective_user.id)
+        keyboard = [
+            [
+                InlineKeyboardButton(f"📚 {name} ({len(data['messages'])})", callback_data=f"batch_{name}"),
+                _sub_button(name, name in subscribed)
+            ]
+            for name, data in batches
+        ]
 
         # Add refresh button at the bottom
-        keyboard.append([InlineKeyboardButton("🔄 Refresh List", callback_data="cmd_listbatches")])
+        keyboard.append([BTN_REFRESH_LIST])
         
         if update.message:
             await update.message.reply_text(
@@ -2262,24 +2746,13 @@ async def list_batches(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 reply_markup=InlineKeyboardMarkup(keyboard)
             )
         else:
-            try:
-                await update.callback_query.edit_message_text(
-                    msg,
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-            except Exception as e:
-                # If editing fails (e.g., message has media), send a new message
-                await update.callback_query.message.reply_text(
-                    msg,
-                    parse_mode="HTML",
-                    reply_markup=InlineKeyboardMarkup(keyboard)
-                )
-                # Try to delete the old message
-                try:
-                    await update.callback_query.message.delete()
-                except Exception as e:
-                    logger.error(f"Error deleting old message: {e}")
+            await _safe_edit(
+                update.callback_query,
+                msg,
+                parse_mode="HTML",
+                reply_markup=InlineKeyboardMarkup(keyboard),
+                delete_old=True
+            )
 
     except Exception as e:
         logger.error(f"Error in list_batches: {e}")
@@ -2287,55 +2760,53 @@ async def list_batches(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if update.message:
             await update.message.reply_text(error_msg)
         elif update.callback_query:
-            try:
-                await update.callback_query.edit_message_text(error_msg)
-            except Exception as e:
-                await update.callback_query.message.reply_text(error_msg)
+            await _safe_edit(update.callback_query, error_msg)
 
-async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Show user profile with subscribed batches"""
-    user = update.effective_user
-    
-    # Update user profile
+def _profile_text(user) -> str:
+    """Record the user's current name and render their profile card"""
     db.update_user_profile(user.id, user.username, user.first_name)
-    
-    # Get user profile and subscriptions
-    profile = db.get_user_profile(user.id)
     subscribed_batches = db.get_user_subscriptions(user.id)
-    
-    # Build profile message
-    msg = f"👤 <b>User Profile</b>\n\n"
-    msg += f"🆔 <b>User ID:</b> {user.id}\n"
-    msg += f"👤 <b>Name:</b> {user.first_name}\n"
+
+    parts = [
+        "👤 <b>User Profile</b>\n\n",
+        f"🆔 <b>User ID:</b> {user.id}\n",
+        f"👤 <b>Name:</b> {user.first_name}\n",
+    ]
     if user.username:
-        msg += f"📝 <b>Username:</b> @{user.username}\n"
-    
+        parts.append(f"📝 <b>Username:</b> @{user.username}\n")
+
     # Add subscription information
     if subscribed_batches:
-        msg += f"\n📚 <b>Subscribed Batches ({len(subscribed_batches)}):</b>\n"
+        parts.append(f"\n📚 <b>Subscribed Batches ({len(subscribed_batches)}):</b>\n")
         for batch_name in subscribed_batches:
-            if batch_name in db.batches:
-                batch = db.batches[batch_name]
-                msg += f"• {batch_name} ({len(batch['messages'])} messages)\n"
+            batch = db.batches.get(batch_name)
+            if batch is not None:
+                parts.append(f"• {batch_name} ({len(batch['messages'])} messages)\n")
     else:
-        msg += "\n📚 <b>No subscribed batches</b>\n"
-        msg += "Use /listbatches to discover and subscribe to batches!"
-    
+        parts.append("\n📚 <b>No subscribed batches</b>\n")
+        parts.append("Use /listbatches to discover and subscribe to batches!")
+
+    created_batches = db.get_created_batches(user.id)
+    if created_batches:
+        parts.append(f"\n🛠 <b>Created Batches ({len(created_batches)}):</b>\n")
+        for batch_name in created_batches:
+            parts.append(f"• {batch_name} ({len(db.batches[batch_name]['messages'])} messages)\n")
+
     # Add stats if available
     user_views = db.stats["users"].get(str(user.id), 0)
     if user_views > 0:
-        msg += f"\n📊 <b>Total Views:</b> {user_views}\n"
-    
-    # Create keyboard
-    keyboard = [
-        [InlineKeyboardButton("📚 View All Batches", callback_data="cmd_listbatches")],
-        [InlineKeyboardButton("🔄 Refresh Profile", callback_data="cmd_profile")]
-    ]
+        parts.append(f"\n📊 <b>Total Views:</b> {user_views}\n")
+    return "".join(parts)
+
+async def profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Show user profile with subscribed batches"""
+    user = update.effective_user
     
+    msg = _profile_text(user)
     await update.message.reply_text(
         msg,
         parse_mode="HTML",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=KB_PROFILE
     )
 
 async def search_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2355,7 +2826,7 @@ async def search_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"search_date_{name}")])
 
     # Add back button
-    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="cmd_help")])
+    keyboard.append([BTN_BACK_TO_HELP])
 
     await update.message.reply_text(
         "📅 <b>Select a batch to search by date:</b>\n\n"
@@ -2377,27 +2848,10 @@ async def findmsg(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Log the search attempt
     logger.info(f"Searching for message ID: {message_id}")
     
-    # Reload message stores to ensure we have latest data
-    try:
-        db.message_store = FileManager.load_data(MESSAGE_STORE_PATH)
-        db.message_batch = FileManager.load_data(MESSAGE_BATCH_PATH)
-        logger.info(f"Message store size: {len(db.message_store)}")
-        logger.info(f"Message batch size: {len(db.message_batch)}")
-    except Exception as e:
-        logger.error(f"Error loading message stores: {e}")
-        return await update.message.reply_text(
-            "❌ Error accessing message database.\n"
-            "Please try again later or contact support."
-        )
-    
-    # Check both message stores
-    message_data = None
-    if message_id in db.message_store:
-        message_data = db.message_store[message_id]
-        logger.info(f"Found message in message_store: {message_id}")
-    elif message_id in db.message_batch:
-        message_data = db.message_batch[message_id]
-        logger.info(f"Found message in message_batch: {message_id}")
+    # Both stores are write-through, so memory always has the latest data
+    message_data = db.get_message(message_id)
+    if message_data is not None:
+        logger.info(f"Found message: {message_id}")
     else:
         logger.warning(f"Message not found: {message_id}")
         return await update.message.reply_text(
@@ -2407,9 +2861,7 @@ async def findmsg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
 
     # Track view stats
-    db.stats["views"][message_id] = db.stats["views"].get(message_id, 0) + 1
-    db.stats["users"][str(update.effective_user.id)] = db.stats["users"].get(str(update.effective_user.id), 0) + 1
-    db.save_all()
+    db.record_view(message_id, update.effective_user.id)
 
     # Store the original message ID for cleanup
     original_message_id = update.message.message_id
@@ -2420,91 +2872,26 @@ async def findmsg(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.info(f"Message type: {message_data.get('type', 'unknown')}")
         
         # Send the message based on its type
-        if message_data["type"] == "text":
-            sent_message = await update.message.reply_text(
-                f"📝 {message_data['text']}\n\n"
-                f"👤 From: {message_data['first_name']}\n"
-                f"⏱️ This message will be deleted in 5 minutes"
-            )
-            sent_messages.append(sent_message)
-        elif message_data["type"] == "photo":
-            sent_message = await update.message.reply_photo(
-                    message_data["file_id"],
-                    caption=f"📸 {message_data.get('caption', '')}\n\n"
-                           f"👤 From: {message_data['first_name']}\n"
-                           f"⏱️ This message will be deleted in 5 minutes"
-                )
-            sent_messages.append(sent_message)
-        elif message_data["type"] == "video":
-            sent_message = await update.message.reply_video(
-                    message_data["file_id"],
-                    caption=f"🎥 {message_data.get('caption', '')}\n\n"
-                           f"👤 From: {message_data['first_name']}\n"
-                           f"⏱️ This message will be deleted in 5 minutes"
-                )
-            sent_messages.append(sent_message)
-        elif message_data["type"] == "document":
-            sent_message = await update.message.reply_document(
-                    message_data["file_id"],
-                    caption=f"📄 {message_data.get('file_name', '')}\n"
-                           f"{message_data.get('caption', '')}\n\n"
-                           f"👤 From: {message_data['first_name']}\n"
-                           f"⏱️ This message will be deleted in 5 minutes"
-                )
-            sent_messages.append(sent_message)
-        elif message_data["type"] == "voice":
-            sent_message = await update.message.reply_voice(
-                    message_data["file_id"],
-                    caption=f"🎤 Voice Message\n\n"
-                           f"👤 From: {message_data['first_name']}\n"
-                           f"⏱️ This message will be deleted in 5 minutes"
-                )
-            sent_messages.append(sent_message)
-        elif message_data["type"] == "audio":
-            sent_message = await update.message.reply_audio(
-                    message_data["file_id"],
-                    caption=f"🎵 {message_data.get('title', 'Audio')}\n\n"
-                           f"👤 From: {message_data['first_name']}\n"
-                           f"⏱️ This message will be deleted in 5 minutes"
-                )
-            sent_messages.append(sent_message)
-        elif message_data["type"] == "sticker":
-            sent_message = await update.message.reply_sticker(
-                message_data["file_id"]
-            )
-            sent_messages.append(sent_message)
-        elif message_data["type"] == "animation":
-            sent_message = await update.message.reply_animation(
-                    message_data["file_id"],
-                    caption=f"🎬 {message_data.get('caption', '')}\n\n"
-                           f"👤 From: {message_data['first_name']}\n"
-                           f"⏱️ This message will be deleted in 5 minutes"
-                )
-            sent_messages.append(sent_message)
-        else:
+        sent_message = await _send_stored_message(update.message, message_id, message_data)
+        if sent_message is None:
             logger.error(f"Unknown message type: {message_data.get('type', 'unknown')}")
             return await update.message.reply_text(
                 "❌ Unknown message type. Please contact support."
             )
+        sent_messages.append(sent_message)
 
-        # Store message IDs for cleanup
-        message_ids = {
-            'original': original_message_id,
-            'sent': [msg.message_id for msg in sent_messages],
-            'chat_id': update.message.chat_id
-        }
-
-        # Start cleanup task
-        asyncio.create_task(_cleanup_messages(message_ids))
+        # Delete the reply and the original after VIEW_TTL
+        _schedule_cleanup(
+            update.message.chat_id,
+            [msg.message_id for msg in sent_messages] + [original_message_id]
+        )
 
     except Exception as e:
         logger.error(f"Error sending message: {e}")
         await update.message.reply_text(
             "❌ Error retrieving message content. The file might have expired.\n"
             "Please try again or contact support if the issue persists.",
-            reply_markup=InlineKeyboardMarkup([[
-                InlineKeyboardButton("🔙 Back", callback_data="cmd_listbatches")
-            ]])
+            reply_markup=KB_BACK_TO_LIST
     )
 
 async def share_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2517,16 +2904,12 @@ async def share_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     batch_name = " ".join(context.args)
     actual_batch = db.get_batch_key(batch_name)
     if actual_batch not in db.batches:
-        return await update.message.reply_text("❌ Batch not found!")
+        return await update.message.reply_text(_ERR_BATCH_NOT_FOUND)
 
     # Generate a unique share token
-    share_token = f"batch_{actual_batch}_{int(datetime.now().timestamp())}"
-
-    # Store the share token in the batch data
-    if "share_tokens" not in db.batches[actual_batch]:
-        db.batches[actual_batch]["share_tokens"] = []
-    db.batches[actual_batch]["share_tokens"].append(share_token)
-    db.save_all()
+    share_token = "batch_" + db.create_share_token(
+        actual_batch, update.effective_user.id, update.effective_user.first_name
+    )
 
     # Create the share link
     share_link = f"https://t.me/{context.bot.username}?start={share_token}"
@@ -2550,7 +2933,7 @@ async def share_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Create keyboard
     keyboard = [
         [InlineKeyboardButton("📱 View Batch", callback_data=f"batch_{actual_batch}")],
-        [InlineKeyboardButton("🔙 Back to Batch Info", callback_data=f"back_to_batch_{actual_batch}")]
+        [InlineKeyboardButton("🔙 Back to Batch Info", callback_data=_CB_BACK_TO_BATCH + actual_batch)]
     ]
 
     # If there's a banner picture, send it with the share message
@@ -2572,8 +2955,48 @@ async def share_batch(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # Bot Setup
 # ==================
 
+async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE):
+    """Log errors that escape a handler and tell the user something went wrong"""
+    logger.error(f"Error while handling an update: {context.error}")
+    if isinstance(update, Update) and update.effective_message:
+        try:
+            await update.effective_message.reply_text(
+                "❌ An error occurred while processing your request.\n"
+                "Please try again or contact support if the issue persists."
+            )
+        except TelegramError as e:
+            logger.error(f"Error sending error message: {e}")
+
+_reaper_task = None
+
+async def _post_init(app: Application):
+    global _reaper_task
+    db.start_flusher()
+    _reaper_task = asyncio.create_task(_cleanup_reaper(app.bot))
+
+async def _post_shutdown(app: Application):
+    if _reaper_task is not None:
+        _reaper_task.cancel()
+    await db.flush_now()
+
+# Outgoing messages per second overall and per minute in a group chat,
+# just under Telegram's limits so bursts are queued instead of failing with 429s
+OVERALL_MAX_RATE = 28
+GROUP_MAX_RATE = 18
+# Times a request that still hits a 429 is retried after the RetryAfter wait (PTB's default is 0)
+RATE_LIMIT_MAX_RETRIES = 3
+
 def main():
-    app = Application.builder().token(TOKEN).build()
+    builder = Application.builder().token(TOKEN).post_init(_post_init).post_shutdown(_post_shutdown)
+    try:
+        builder.rate_limiter(AIORateLimiter(
+            overall_max_rate=OVERALL_MAX_RATE,
+            group_max_rate=GROUP_MAX_RATE,
+            max_retries=RATE_LIMIT_MAX_RETRIES
+        ))
+    except RuntimeError:  # Needs the python-telegram-bot[rate-limiter] extra
+        logger.warning("aiolimiter is not installed, sending without rate limiting")
+    app = builder.build()
 
     # Core commands
     app.add_handler(CommandHandler("start", start))
@@ -2600,9 +3023,14 @@ def main():
     # Handlers
     app.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_message))
     app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_error_handler(error_handler)
 
+    log_listener.start()
     logger.info("🤖 Bot is running...")
-    app.run_polling()
+    try:
+        app.run_polling()
+    finally:
+        log_listener.stop()  # Drains records still in the queue
 
 if __name__ == "__main__":
     main()